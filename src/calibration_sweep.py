@@ -0,0 +1,165 @@
+from calibrator import Calibrator
+from rgbd_capture import RGBDCapture
+from robot import Robot
+from stoppable_thread import StoppableThread
+from numpy.typing import NDArray
+import numpy as np
+from typing import Optional, Tuple
+import threading
+import time
+
+
+def make_sweep_grid(center: NDArray, extent: Tuple[float, float, float], shape: Tuple[int, int, int]) -> NDArray:
+    '''Returns the (N, 3) points of a grid of the given shape spanning extent
+    around center, in serpentine order so consecutive points are adjacent.'''
+    axes = [np.linspace(c - e / 2.0, c + e / 2.0, n) if n > 1 else np.array([c])
+            for c, e, n in zip(center, extent, shape)]
+    points = []
+    for i, z in enumerate(axes[2]):
+        ys = axes[1] if i % 2 == 0 else axes[1][::-1]
+        for j, y in enumerate(ys):
+            xs = axes[0] if (i * len(ys) + j) % 2 == 0 else axes[0][::-1]
+            points.extend([x, y, z] for x in xs)
+    return np.array(points)
+
+
+class PoseHistory:
+    '''Samples the robot's TCP position on a background thread into a
+    bounded history, so positions can be interpolated at any recent time.'''
+
+    def __init__(self, robot: Robot, rate: float = 125.0, size: int = 2048) -> None:
+        self.robot = robot
+        self.rate = rate
+        self.times = np.zeros(size)
+        self.positions = np.zeros((size, 3))
+        self.count = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = StoppableThread(self._sample_loop, name='PoseHistory')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.join()
+            self.thread = None
+
+    def _sample_loop(self, stop_event: threading.Event, args) -> None:
+        while not stop_event.wait(1.0 / self.rate):
+            # Read the pose between two clock reads and stamp it halfway.
+            start = time.monotonic()
+            position = self.robot.get_pose(Robot.TRANSLATION)
+            timestamp = 0.5 * (start + time.monotonic())
+            with self.lock:
+                index = self.count % len(self.times)
+                self.times[index] = timestamp
+                self.positions[index] = position
+                self.count += 1
+
+    def latest(self) -> Optional[NDArray]:
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.positions[(self.count - 1) % len(self.times)].copy()
+
+    def interpolate(self, timestamp: float) -> Optional[NDArray]:
+        '''Returns the position at timestamp, or None if it is outside the
+        sampled history.'''
+        with self.lock:
+            n = min(self.count, len(self.times))
+            # Oldest sample first
+            order = (np.arange(n) + self.count - n) % len(self.times)
+            times, positions = self.times[order], self.positions[order]
+        if n < 2 or not times[0] <= timestamp <= times[-1]:
+            return None
+        return np.array([np.interp(timestamp, times, positions[:, axis]) for axis in range(3)])
+
+
+class CalibrationSweep:
+    '''Calibrates without an operator: drives the robot through a grid of
+    positions with asynchronous moves while frames are captured in the
+    background, and pairs every marker detection with the robot position
+    interpolated at the frame's capture time (minus camera_latency).
+
+    Uses the calibrator's stream, robot, marker tracker and solver; the
+    result is calibrator.compute_calibration_matrix().
+    '''
+
+    def __init__(
+        self,
+        calibrator: Calibrator,
+        extent: Tuple[float, float, float] = (0.2, 0.2, 0.1),
+        shape: Tuple[int, int, int] = (4, 4, 3),
+        center: Optional[NDArray] = None,
+        speed: float = 0.05,
+        acceleration: float = 0.5,
+        arrival_tolerance: float = 0.001,
+        move_timeout: float = 20.0,
+        camera_latency: float = 0.0,
+        stop_on_convergence: bool = False,
+    ) -> None:
+        self.calibrator = calibrator
+        self.robot = calibrator.robot
+        if center is None:
+            center = self.robot.get_pose(Robot.TRANSLATION)
+        self.grid = make_sweep_grid(np.asarray(center), extent, shape)
+        self.speed = speed
+        self.acceleration = acceleration
+        self.arrival_tolerance = arrival_tolerance
+        self.move_timeout = move_timeout
+        self.camera_latency = camera_latency
+        self.stop_on_convergence = stop_on_convergence
+
+        self.detection_count = 0
+        self.unmatched_count = 0
+
+    def _process_frame(self, capture: RGBDCapture, poses: PoseHistory, last_seq: int) -> int:
+        frame, seq, timestamp = capture.get_latest_frame()
+        if seq == last_seq:
+            return seq
+
+        marker_position, _ = self.calibrator.find_marker_position(frame)
+        if marker_position is None:
+            return seq
+        self.detection_count += 1
+
+        robot_position = poses.interpolate(timestamp - self.camera_latency)
+        if robot_position is None:
+            self.unmatched_count += 1
+            return seq
+        self.calibrator.solver.add(marker_position, robot_position)
+        return seq
+
+    def run(self) -> NDArray:
+        poses = PoseHistory(self.robot)
+        capture = RGBDCapture(self.calibrator.stream)
+        poses.start()
+        capture.start()
+        try:
+            last_seq = 0
+            for i, target in enumerate(self.grid):
+                self.robot.set_pose(target, Robot.TRANSLATION, speed=self.speed,
+                                    acceleration=self.acceleration, asynchronous=True)
+                start = time.monotonic()
+                while time.monotonic() - start < self.move_timeout:
+                    capture.wait_for_frame(timeout=0.1)
+                    last_seq = self._process_frame(capture, poses, last_seq)
+
+                    position = poses.latest()
+                    if position is not None and np.linalg.norm(position - target) < self.arrival_tolerance:
+                        break
+                else:
+                    print(f'Sweep: timed out moving to point {i}')
+
+                print(f'Sweep: {i + 1}/{len(self.grid)} points, {self.calibrator.solver.count} samples')
+                if self.stop_on_convergence and self.calibrator.solver.converged:
+                    break
+        finally:
+            self.robot.control.stopL(self.acceleration)
+            capture.stop()
+            poses.stop()
+
+        return self.calibrator.compute_calibration_matrix()
@@ -1,76 +1,59 @@
 from __future__ import annotations
 from rgbd_stream import RGBDStream, RGBDFrame
 from robot import Robot
+from marker_tracker import MarkerTracker
+from incremental_kabsch import IncrementalKabsch, kabsch
 from numpy.typing import NDArray
 import numpy as np
-from typing import Tuple
+from typing import Optional, Tuple
 import cv2
 
 
 class Calibrator:
-    def __init__(self, stream: RGBDStream, robot: Robot, marker_color: NDArray, N: int = 1000) -> None:
+    def __init__(self, stream: RGBDStream, robot: Robot, marker_color: NDArray, N: int = 1000,
+                 tracker: Optional[MarkerTracker] = None, display_interval: int = 4,
+                 solver: Optional[IncrementalKabsch] = None) -> None:
         self.robot = robot
         self.stream = stream
         self.marker_color = marker_color
         self.N = N
-        self.world_space_points = []
-        self.robot_space_points = []
+        self.tracker = tracker if tracker is not None else MarkerTracker(marker_color)
+        # Only every display_interval-th frame is shown.
+        self.display_interval = display_interval
+        self.frame_count = 0
+        # Calibration stops once the fit converges, or after N accepted
+        # samples if they are spread widely enough (see IncrementalKabsch).
+        self.solver = solver if solver is not None else IncrementalKabsch()
         self.calibration_matrix = None
 
         if not self.stream.is_running():
             self.stream.start()
 
-    def _find_marker_position(self, frame: RGBDFrame) -> Tuple[NDArray | None, NDArray]:
-        difference = frame.resized_rgb - self.marker_color
-        mask = np.sum(difference * difference, axis=-1) < 0.03
-        indices_y, indices_x = np.where(mask)
-
-        if len(indices_x) == 0:
-            return None, mask
-
-        marker_points = frame.camera.screen_to_world(
-            frame.xyz[indices_y, indices_x],
-            width=frame.xyz.shape[1],
-            height=frame.xyz.shape[0])
-
-        return np.mean(marker_points, axis=0), mask
+    def find_marker_position(self, frame: RGBDFrame) -> Tuple[NDArray | None, NDArray]:
+        '''Returns the marker's world position in frame (None if not found)
+        and the tracker's match mask; see MarkerTracker.find().'''
+        return self.tracker.find(frame)
 
     def _get_robot_position(self) -> NDArray:
         return self.robot.get_pose(Robot.TRANSLATION)
 
     def _kabsch_algorithm(self, P: NDArray, Q: NDArray) -> Tuple[NDArray, NDArray]:
-        centroid_P = np.mean(P, axis=0)
-        centroid_Q = np.mean(Q, axis=0)
-
-        P_centered = P - centroid_P
-        Q_centered = Q - centroid_Q
-
-        H = P_centered.T @ Q_centered
-        U, S, Vt = np.linalg.svd(H)
-        R = Vt.T @ U.T
-
-        if np.linalg.det(R) < 0:
-            Vt[-1, :] *= -1
-            R = Vt.T @ U.T
-
-        t = centroid_Q - R @ centroid_P
-
-        return R, t
+        return kabsch(P, Q)
 
     def is_calibrating(self) -> bool:
-        return len(self.world_space_points) < self.N
+        if self.solver.converged:
+            return False
+        return self.solver.count < self.N or not self.solver.is_well_spread()
 
     def calibrate(self, display_frame: bool = True) -> None:
         self.stream.wait_for_frames()
-        frame = self.stream.get_frame()
+        frame = self.stream.acquire_frame()
+        self.frame_count += 1
 
-        marker_position, mask = self._find_marker_position(frame)
+        marker_position, mask = self.find_marker_position(frame)
 
-        if display_frame:
-            mask = cv2.resize(
-                mask.astype(np.uint8), (frame.rgb.shape[1], frame.rgb.shape[0]))[:, :, None]
-            bgr = cv2.cvtColor(frame.rgb, cv2.COLOR_RGB2BGR) * (1 - mask)
-            cv2.imshow('Camera Feed', bgr)
+        if display_frame and self.frame_count % self.display_interval == 0:
+            cv2.imshow('Camera Feed', self.tracker.draw(frame, mask))
             cv2.waitKey(1)
 
         if marker_position is None:
@@ -78,17 +61,12 @@ class Calibrator:
 
         robot_position = self._get_robot_position()
 
-        self.world_space_points.append(marker_position)
-        self.robot_space_points.append(robot_position)
-
-        print(f"Calibrating: {100.0 * len(self.world_space_points) / self.N}%")
+        if self.solver.add(marker_position, robot_position):
+            message = (f"Calibrating: {100.0 * self.solver.count / self.N}% "
+                       f"({self.solver.rejected_count} outliers rejected)")
+            if not self.solver.is_well_spread():
+                message += f", move the marker around more (spread {np.round(self.solver.spread, 3)} m)"
+            print(message)
 
     def compute_calibration_matrix(self) -> NDArray:
-        rotation, translation = self._kabsch_algorithm(
-            np.array(self.world_space_points), np.array(self.robot_space_points))
-
-        matrix = np.eye(4)
-        matrix[0:3, 0:3] = rotation
-        matrix[0:3, 3] = translation
-
-        return matrix
+        return self.solver.get_matrix()
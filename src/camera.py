@@ -1,66 +1,180 @@
 import numpy as np
 from numpy.typing import NDArray
+from typing import Dict, Optional, Tuple
+
+# Added to depths before perspective division
+_EPSILON = 1e-6
+
+
+def _as_batch(points: NDArray, out: Optional[NDArray]) -> Tuple[NDArray, NDArray, NDArray]:
+    '''Returns points and out as (N, 3) arrays, allocating out if needed,
+    plus out in the shape of points for returning.'''
+    points = np.asarray(points, dtype=np.float64)
+    if out is None:
+        out = np.empty(points.shape, dtype=np.result_type(points, np.float32))
+    elif out.shape != points.shape or not out.flags.c_contiguous:
+        raise ValueError('out must be a C-contiguous array shaped like the input')
+    return points.reshape(-1, 3), out.reshape(-1, 3), out
+
+
+def project(points: NDArray, matrix: NDArray, perspective: bool, out: Optional[NDArray] = None) -> NDArray:
+    '''Applies a 3x4 projection matrix to (..., 3) points: one matmul, then
+    one divide of x and y by the depth (third row) if perspective.'''
+    points, batch, out = _as_batch(points, out)
+    np.matmul(points, matrix[:, :3].T, out=batch)
+    batch += matrix[:, 3]
+    if perspective:
+        depth = batch[:, 2:3] + _EPSILON
+        batch[:, :2] /= depth
+    return out
+
+
+def unproject(points: NDArray, matrix: NDArray, perspective: bool, out: Optional[NDArray] = None) -> NDArray:
+    '''Inverse of project(): maps (..., 3) points (x, y, depth) through
+    matrix @ (x * depth, y * depth, depth, 1) if perspective, else through
+    matrix @ (x, y, depth, 1).'''
+    points, batch, out = _as_batch(points, out)
+    if perspective:
+        np.matmul(points[:, :2], matrix[:, :2].T, out=batch)
+        batch += matrix[:, 2]
+        batch *= points[:, 2:3]
+    else:
+        np.matmul(points, matrix[:, :3].T, out=batch)
+    batch += matrix[:, 3]
+    return out
 
 
 class Intrinsics:
+    '''Normalized pinhole or orthographic intrinsics. Treated as immutable
+    once constructed, since pixel matrices are cached per image size.'''
+
     def __init__(self, width: float, height: float, fx: float, fy: float, px: float, py: float, orthographic: bool = False) -> None:
         self.fx, self.fy = fx / width, fy / height
         self.px, self.py = px / width, py / height
         self.orthographic = orthographic
 
-    def camera_to_screen(self, XYZ: NDArray, width: int, height: int) -> NDArray:
-        if self.orthographic:
-            x = XYZ[..., 0] * self.fx + self.px
-            y = XYZ[..., 1] * self.fy + self.py
-        else:
-            x = XYZ[..., 0] / (XYZ[..., 2] + 1e-6) * self.fx + self.px
-            y = XYZ[..., 1] / (XYZ[..., 2] + 1e-6) * self.fy + self.py
-
-        z = XYZ[..., 2]
-
-        return np.stack([width * x, height * y, z], axis=-1)
-
-    def screen_to_camera(self, xyz: NDArray, width: int, height: int) -> NDArray:
-        if self.orthographic:
-            X = (xyz[..., 0] / width - self.px) / self.fx
-            Y = (xyz[..., 1] / height - self.py) / self.fy
-        else:
-            X = ((xyz[..., 0] / width - self.px) / self.fx) * xyz[..., 2]
-            Y = ((xyz[..., 1] / height - self.py) / self.fy) * xyz[..., 2]
-
-        Z = xyz[..., 2]
-
-        return np.stack([X, Y, Z], axis=-1)
+        # Mapping: (width, height) -> (camera to pixel 3x4, pixel to camera 3x4)
+        self._matrices: Dict[Tuple[int, int], Tuple[NDArray, NDArray]] = {}
+
+    def get_matrices(self, width: int, height: int) -> Tuple[NDArray, NDArray]:
+        key = (width, height)
+        matrices = self._matrices.get(key)
+        if matrices is None:
+            K = np.array([
+                [width * self.fx, 0.0, width * self.px],
+                [0.0, height * self.fy, height * self.py],
+                [0.0, 0.0, 1.0]])
+            if self.orthographic:
+                # Offsets do not scale with depth.
+                projection = np.zeros((3, 4))
+                projection[:, :3] = K
+                projection[:2, 2] = 0.0
+                projection[:2, 3] = K[:2, 2]
+            else:
+                projection = np.hstack([K, np.zeros((3, 1))])
+            unprojection = np.linalg.inv(np.vstack([projection, [0.0, 0.0, 0.0, 1.0]]))[:3]
+            matrices = (projection, unprojection)
+            self._matrices[key] = matrices
+        return matrices
+
+    def camera_to_screen(self, XYZ: NDArray, width: int, height: int, out: Optional[NDArray] = None) -> NDArray:
+        projection, _ = self.get_matrices(width, height)
+        return project(XYZ, projection, not self.orthographic, out)
+
+    def screen_to_camera(self, xyz: NDArray, width: int, height: int, out: Optional[NDArray] = None) -> NDArray:
+        _, unprojection = self.get_matrices(width, height)
+        return unproject(xyz, unprojection, not self.orthographic, out)
 
 
 class Camera:
-    def __init__(self, intrinsics: Intrinsics, position: NDArray, rotation_matrix: NDArray) -> None:
+    def __init__(self, intrinsics: Intrinsics, position: NDArray, rotation_matrix: NDArray, inverse_rotation_matrix: NDArray = None) -> None:
         self.intrinsics = intrinsics
-        self.position = position
-        self.rotation_matrix = rotation_matrix
-        self.inverse_rotation_matrix = np.linalg.inv(self.rotation_matrix)
-
-    def world_to_camera(self, XYZ: NDArray) -> NDArray:
-        XYZ = XYZ - self.position
-        XYZ = XYZ @ self.inverse_rotation_matrix.T
-        return XYZ
-
-    def camera_to_screen(self, XYZ: NDArray, width: int, height: int) -> NDArray:
-        return self.intrinsics.camera_to_screen(XYZ, width, height)
-
-    def world_to_screen(self, XYZ: NDArray, width: int, height: int) -> NDArray:
-        return self.camera_to_screen(self.world_to_camera(XYZ), width, height)
-
-    def screen_to_camera(self, xyz: NDArray, width: int, height: int) -> NDArray:
-        return self.intrinsics.screen_to_camera(xyz, width, height)
-
-    def camera_to_world(self, XYZ: NDArray) -> NDArray:
-        XYZ = XYZ @ self.rotation_matrix.T
-        XYZ += self.position
-        return XYZ
-
-    def screen_to_world(self, xyz: NDArray, width: int, height: int) -> NDArray:
-        return self.camera_to_world(self.screen_to_camera(xyz, width, height))
+        self._position = position
+        self._rotation_matrix = rotation_matrix
+        if inverse_rotation_matrix is None:
+            inverse_rotation_matrix = np.linalg.inv(self.rotation_matrix)
+        self._inverse_rotation_matrix = inverse_rotation_matrix
+
+        # Mapping: (width, height) -> (world to pixel 3x4, pixel to world 3x4);
+        # cleared whenever the pose changes.
+        self._matrices: Dict[Tuple[int, int], Tuple[NDArray, NDArray]] = {}
+        self._extrinsics: Optional[Tuple[NDArray, NDArray]] = None
+
+    @property
+    def position(self) -> NDArray:
+        return self._position
+
+    @position.setter
+    def position(self, position: NDArray) -> None:
+        self._position = position
+        self._clear_matrices()
+
+    @property
+    def rotation_matrix(self) -> NDArray:
+        return self._rotation_matrix
+
+    @rotation_matrix.setter
+    def rotation_matrix(self, rotation_matrix: NDArray) -> None:
+        self._rotation_matrix = rotation_matrix
+        self._clear_matrices()
+
+    @property
+    def inverse_rotation_matrix(self) -> NDArray:
+        return self._inverse_rotation_matrix
+
+    @inverse_rotation_matrix.setter
+    def inverse_rotation_matrix(self, inverse_rotation_matrix: NDArray) -> None:
+        self._inverse_rotation_matrix = inverse_rotation_matrix
+        self._clear_matrices()
+
+    def _clear_matrices(self) -> None:
+        self._matrices = {}
+        self._extrinsics = None
+
+    def get_extrinsic_matrices(self) -> Tuple[NDArray, NDArray]:
+        '''Returns the 3x4 world to camera and camera to world matrices.'''
+        if self._extrinsics is None:
+            world_to_camera = np.hstack([
+                self.inverse_rotation_matrix, (-self.inverse_rotation_matrix @ self.position)[:, None]])
+            camera_to_world = np.hstack([self.rotation_matrix, np.reshape(self.position, (3, 1))])
+            self._extrinsics = (world_to_camera, camera_to_world)
+        return self._extrinsics
+
+    def get_matrices(self, width: int, height: int) -> Tuple[NDArray, NDArray]:
+        '''Returns the 3x4 world to pixel and pixel to world matrices for
+        images of the given size; see project() and unproject().'''
+        key = (width, height)
+        matrices = self._matrices.get(key)
+        if matrices is None:
+            world_to_camera, camera_to_world = self.get_extrinsic_matrices()
+            projection, unprojection = self.intrinsics.get_matrices(width, height)
+            bottom_row = np.array([[0.0, 0.0, 0.0, 1.0]])
+            matrices = (projection @ np.vstack([world_to_camera, bottom_row]),
+                        camera_to_world @ np.vstack([unprojection, bottom_row]))
+            self._matrices[key] = matrices
+        return matrices
+
+    def world_to_camera(self, XYZ: NDArray, out: Optional[NDArray] = None) -> NDArray:
+        world_to_camera, _ = self.get_extrinsic_matrices()
+        return project(XYZ, world_to_camera, False, out)
+
+    def camera_to_screen(self, XYZ: NDArray, width: int, height: int, out: Optional[NDArray] = None) -> NDArray:
+        return self.intrinsics.camera_to_screen(XYZ, width, height, out)
+
+    def world_to_screen(self, XYZ: NDArray, width: int, height: int, out: Optional[NDArray] = None) -> NDArray:
+        world_to_screen, _ = self.get_matrices(width, height)
+        return project(XYZ, world_to_screen, not self.intrinsics.orthographic, out)
+
+    def screen_to_camera(self, xyz: NDArray, width: int, height: int, out: Optional[NDArray] = None) -> NDArray:
+        return self.intrinsics.screen_to_camera(xyz, width, height, out)
+
+    def camera_to_world(self, XYZ: NDArray, out: Optional[NDArray] = None) -> NDArray:
+        _, camera_to_world = self.get_extrinsic_matrices()
+        return project(XYZ, camera_to_world, False, out)
+
+    def screen_to_world(self, xyz: NDArray, width: int, height: int, out: Optional[NDArray] = None) -> NDArray:
+        _, screen_to_world = self.get_matrices(width, height)
+        return unproject(xyz, screen_to_world, not self.intrinsics.orthographic, out)
 
     def get_clip_mask(self, xyz: NDArray, width: int, height: int, depth: NDArray = None) -> NDArray:
         is_valid = (xyz[..., 0] >= 0) & (xyz[..., 0] <= width - 1)
@@ -88,7 +202,11 @@ class Camera:
     def forward(self) -> NDArray:
         return np.array([0.0, 0.0, 1.0]) @ self.rotation_matrix.T
 
-    def calibrate(self, transform: NDArray):
+    def calibrate(self, transform: NDArray, inverse_transform_rotation: NDArray = None):
+        '''Applies transform (4x4) to the pose. Pass the inverse of its
+        rotation part when calibrating many cameras with the same transform.'''
+        if inverse_transform_rotation is None:
+            inverse_transform_rotation = np.linalg.inv(transform[0:3, 0:3])
         self.position = transform[0:3, 0:3] @ self.position + transform[0:3, 3]
         self.rotation_matrix = transform[0:3, 0:3] @ self.rotation_matrix
-        self.inverse_rotation_matrix = np.linalg.inv(self.rotation_matrix)
+        self.inverse_rotation_matrix = self.inverse_rotation_matrix @ inverse_transform_rotation
@@ -1,26 +1,85 @@
 from rgbd_stream import RGBDStream
+from rgbd_capture import RGBDCapture
+from rgbd_recording import RGBDSessionRecorder
+from typing import Any, Dict, List, Optional, Tuple
 import numpy as np
 from numpy.typing import NDArray
+import time
 import cv2
 
+# Screen coordinates are clamped to this before drawing, so points close to
+# the camera plane cannot overflow OpenCV's int32 coordinates.
+_MAX_SCREEN_COORDINATE = 1 << 20
+# Same as cv2.arrowedLine's default tip length
+_ARROW_TIP_LENGTH = 0.1
+
 
 class CameraFeed:
-    def __init__(self, window_title: str, stream: RGBDStream, calibration_matrix: NDArray = np.eye(4)) -> None:
+    def __init__(self, window_title: str, stream: RGBDStream, calibration_matrix: NDArray = np.eye(4),
+                 background_capture: bool = False) -> None:
+        '''With background_capture, frames are captured on a separate thread
+        and update_window() never waits for the camera: it shows the newest
+        frame, or redraws the current one if none has arrived since.'''
         self.window_title = window_title
         self.stream = stream
         self.calibration_matrix = calibration_matrix
+        self.inverse_calibration_rotation = np.linalg.inv(calibration_matrix[0:3, 0:3])
 
         if not self.stream.is_running():
             self.stream.start()
 
+        # Overlays queued by the add_world_* methods, drawn by draw_overlays()
+        self._points: List[Tuple[NDArray, int, Any]] = []
+        self._arrows: List[Tuple[NDArray, NDArray, int, Any]] = []
+        self._polylines: List[Tuple[NDArray, int, Any, Optional[str]]] = []
+        # Mapping: cache key -> (points, world to pixel matrix, projected runs)
+        self._polyline_cache: Dict[str, Tuple[NDArray, NDArray, List[NDArray]]] = {}
+
+        self.recorder = None
+        self.capture = None
+        self.frame_seq = 0
+        self.frame_timestamp = 0.0
+        if background_capture:
+            self.capture = RGBDCapture(stream)
+            self.capture.start()
+            self.capture.wait_for_frame()
+
         self._get_new_frame()
 
     def _get_new_frame(self) -> None:
-        self.stream.wait_for_frames()
-        self.frame = self.stream.get_frame()
-        self.frame.camera.calibrate(self.calibration_matrix)
+        if self.capture is None:
+            self.stream.wait_for_frames()
+            self.frame = self.stream.get_frame()
+        else:
+            frame, seq, timestamp = self.capture.get_latest_frame()
+            if seq == self.frame_seq:
+                # Nothing new yet; clear the overlays off the current frame.
+                np.copyto(self.rgb, self.frame.rgb)
+                return
+            self.frame, self.frame_seq, self.frame_timestamp = frame, seq, timestamp
+        if self.recorder is not None:
+            self._record_frame()
+        self.frame.camera.calibrate(self.calibration_matrix, self.inverse_calibration_rotation)
         self.rgb = np.copy(self.frame.rgb)
 
+    def _record_frame(self) -> None:
+        timestamp = None
+        if self.capture is not None:
+            # Convert the capture time to the wall clock the controller logs use.
+            timestamp = time.time() - (time.monotonic() - self.frame_timestamp)
+        self.recorder.write(self.frame, timestamp)
+
+    def start_recording(self, directory: str, **kwargs) -> None:
+        '''Records every new frame, uncalibrated, with an RGBDSessionRecorder
+        created with kwargs.'''
+        self.stop_recording()
+        self.recorder = RGBDSessionRecorder(directory, **kwargs)
+
+    def stop_recording(self) -> None:
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
     def draw_world_point(self, point: NDArray, radius: int, color: NDArray) -> None:
         width, height = self.rgb.shape[1], self.rgb.shape[0]
         x, y, z = self.frame.camera.world_to_screen(point, width, height)
@@ -42,7 +101,91 @@ class CameraFeed:
         cv2.arrowedLine(self.rgb, (int(x1), int(y1)),
                         (int(x2), int(y2)), color=color, thickness=thickness)
 
+    def add_world_point(self, point: NDArray, radius: int, color: NDArray) -> None:
+        self._points.append((point, radius, color))
+
+    def add_world_arrow(self, point1: NDArray, point2: NDArray, thickness: int, color: NDArray) -> None:
+        self._arrows.append((point1, point2, thickness, color))
+
+    def add_world_polyline(self, points: NDArray, thickness: int, color: NDArray, cache_key: Optional[str] = None) -> None:
+        '''Queues an (N, 3) polyline. With cache_key, its projection is reused
+        for as long as the same points array is passed and the camera pose
+        stays the same, e.g. for a static reference path.'''
+        self._polylines.append((points, thickness, color, cache_key))
+
+    def _get_cached_polyline(self, points: NDArray, cache_key: Optional[str], matrix: NDArray) -> Optional[List[NDArray]]:
+        if cache_key is None or cache_key not in self._polyline_cache:
+            return None
+        cached_points, cached_matrix, runs = self._polyline_cache[cache_key]
+        if cached_points is not points or not np.allclose(cached_matrix, matrix, rtol=1e-6, atol=1e-9):
+            return None
+        return runs
+
+    def draw_overlays(self) -> None:
+        '''Draws everything queued by the add_world_* methods: all points are
+        projected in one call, and all arrows and polylines of a style are
+        drawn with one cv2.polylines call.'''
+        width, height = self.rgb.shape[1], self.rgb.shape[0]
+        matrix, _ = self.frame.camera.get_matrices(width, height)
+
+        polyline_runs = [self._get_cached_polyline(points, cache_key, matrix)
+                         for points, _, _, cache_key in self._polylines]
+        world = [np.reshape([point for point, _, _ in self._points], (-1, 3)),
+                 np.reshape([(point1, point2) for point1, point2, _, _ in self._arrows], (-1, 3))]
+        world += [points for (points, _, _, _), runs in zip(self._polylines, polyline_runs) if runs is None]
+        screen = self.frame.camera.world_to_screen(np.concatenate(world), width, height)
+        is_visible = screen[:, 2] >= 0
+        pixels = np.clip(screen[:, :2], -_MAX_SCREEN_COORDINATE, _MAX_SCREEN_COORDINATE).astype(np.int32)
+
+        # Mapping: (thickness, color) -> polylines
+        styles: Dict[Tuple[int, Tuple], List[NDArray]] = {}
+        offset = 0
+
+        for (_, radius, color), pixel, visible in zip(self._points, pixels, is_visible):
+            if visible:
+                cv2.circle(self.rgb, (int(pixel[0]), int(pixel[1])), radius=radius, color=color, thickness=-1)
+        offset += len(self._points)
+
+        n_arrows = len(self._arrows)
+        if n_arrows > 0:
+            ends = screen[offset:offset + 2 * n_arrows, :2].reshape(-1, 2, 2)
+            delta = ends[:, 0] - ends[:, 1]
+            angle = np.arctan2(delta[:, 1], delta[:, 0])[:, None]
+            tip_size = (np.linalg.norm(delta, axis=-1) * _ARROW_TIP_LENGTH)[:, None]
+            heads = [ends[:, 1] + tip_size * np.hstack([np.cos(angle + turn), np.sin(angle + turn)])
+                     for turn in (np.pi / 4, -np.pi / 4)]
+            shapes = np.stack([ends[:, 0], ends[:, 1], heads[0], ends[:, 1], heads[1]], axis=1)
+            shapes = np.clip(shapes, -_MAX_SCREEN_COORDINATE, _MAX_SCREEN_COORDINATE).astype(np.int32)
+            visible = is_visible[offset:offset + 2 * n_arrows].reshape(-1, 2).all(axis=1)
+            for (_, _, thickness, color), shape, shown in zip(self._arrows, shapes, visible):
+                if shown:
+                    styles.setdefault((thickness, tuple(color)), []).extend([shape[:2], shape[2:]])
+            offset += 2 * n_arrows
+
+        for (points, thickness, color, cache_key), runs in zip(self._polylines, polyline_runs):
+            if runs is None:
+                end = offset + len(points)
+                # Split the polyline wherever it goes behind the camera.
+                visible_indices = np.flatnonzero(is_visible[offset:end])
+                runs = [pixels[offset:end][indices] for indices in
+                        np.split(visible_indices, np.flatnonzero(np.diff(visible_indices) != 1) + 1)
+                        if len(indices) >= 2]
+                offset = end
+                if cache_key is not None:
+                    self._polyline_cache[cache_key] = (points, matrix, runs)
+            styles.setdefault((thickness, tuple(color)), []).extend(runs)
+
+        for (thickness, color), polylines in styles.items():
+            cv2.polylines(self.rgb, polylines, isClosed=False, color=color, thickness=thickness)
+
+        self._points.clear()
+        self._arrows.clear()
+        self._polylines.clear()
+
     def update_window(self) -> None:
+        if self._points or self._arrows or self._polylines:
+            self.draw_overlays()
+
         bgr = cv2.cvtColor(self.rgb, cv2.COLOR_RGB2BGR)
         cv2.imshow(self.window_title, bgr)
         cv2.waitKey(1)
@@ -54,3 +197,9 @@ class CameraFeed:
                     (cv2.cvtColor(self.frame.rgb, cv2.COLOR_RGB2BGR) * 255.0).astype(np.uint8))
         cv2.imwrite(f'{directory}/{name}_d.bmp',
                     (np.clip(self.frame.depth, 0.0, 16.0) * 1000.0).astype(np.uint16))
+
+    def close(self) -> None:
+        self.stop_recording()
+        if self.capture is not None:
+            self.capture.stop()
+            self.capture = None
@@ -1,61 +1,115 @@
 import multiprocessing as mp
 import numpy as np
-import time
-from typing import Callable, Dict, Any
+import queue as queue_module
+from typing import Callable, Dict, Any, Optional
 from rgbd_stream import RGBDStream_iOS
 from camera_feed import CameraFeed
+from shared_slot import SharedSlot, FieldSpec
 
 class CameraProcess:
+    '''Shows the camera feed in a separate process, with overlays drawn by
+    update_fn(camera_feed, state).
+
+    With state_fields, the state lives in a SharedSlot: write_state()
+    overwrites it in place, and the render process draws the newest
+    complete state once per displayed frame, so the display lags the
+    controller by at most one frame no matter how often it writes.
+    Otherwise states are sent as messages with send(), and the render
+    process draws every message in order, so it falls behind if they come
+    faster than the camera's frame rate.
+    '''
+
     def __init__(
         self,
         update_fn: Callable[[CameraFeed, Dict[str, Any]], None],
         init_pose: np.ndarray,
         calibration_path: str = 'calibration_matrix.npy',
+        state_fields: Optional[FieldSpec] = None,
     ):
         self.queue = mp.Queue()
+        self.started = mp.Event()
+        self.stopped = mp.Event()
+        self.state = SharedSlot(state_fields) if state_fields is not None else None
+        state_spec = self.state.spec() if self.state is not None else None
         self.proc = mp.Process(
             target=self._worker,
-            args=(self.queue, update_fn, init_pose, calibration_path)
+            args=(self.queue, self.started, self.stopped, state_spec, update_fn, init_pose, calibration_path)
         )
 
     def start(self):
         self.proc.start()
 
     def send(self, message: Dict[str, Any]):
+        if message is not None and message.get("start", False):
+            self.started.set()
         self.queue.put(message)
 
+    def start_drawing(self):
+        self.started.set()
+
+    def write_state(self, **values: Any) -> int:
+        return self.state.write(**values)
+
     def terminate(self):
+        self.stopped.set()
         self.queue.put(None)
         self.proc.join()
+        if self.state is not None:
+            self.state.close()
+            self.state = None
 
     @staticmethod
-    def _worker(queue, update_fn, init_pose, calibration_path):
+    def _worker(queue, started, stopped, state_spec, update_fn, init_pose, calibration_path):
         rgbd_stream = RGBDStream_iOS()
         calibration_matrix = np.load(calibration_path)
         camera_feed = CameraFeed("Camera Feed", rgbd_stream, calibration_matrix)
 
-        # Init phase: render yellow dot until 'start' signal is received
-        started = False
-        while not started:
-            camera_feed.draw_world_point(init_pose[:3], radius=10, color=(0xff, 0xff, 0))
-            camera_feed.update_window()
-
-            if not queue.empty():
-                msg = queue.get()
-                if msg is None:
+        state_slot = SharedSlot.attach(state_spec) if state_spec is not None else None
+        try:
+            # Init phase: render yellow dot until 'start' signal is received
+            while not started.is_set():
+                if stopped.is_set():
                     return
-                if msg.get("start", False):
-                    started = True
+                camera_feed.draw_world_point(init_pose[:3], radius=10, color=(0xff, 0xff, 0))
+                camera_feed.update_window()
+
+            if state_slot is not None:
+                CameraProcess._draw_shared_state(camera_feed, state_slot, stopped, update_fn)
             else:
-                time.sleep(0.01)
+                CameraProcess._draw_messages(camera_feed, queue, stopped, update_fn)
+        finally:
+            if state_slot is not None:
+                state_slot.close()
+
+    @staticmethod
+    def _draw_shared_state(camera_feed, state_slot, stopped, update_fn):
+        # Main loop: draw the newest state on every frame; update_window()
+        # waiting for the next camera frame paces the loop. Snapshots are
+        # read into a scratch copy so that a writer stuck mid-write only
+        # keeps the last good state on screen.
+        state = {field: np.empty_like(view) for field, view in state_slot.views.items()}
+        scratch = {field: np.empty_like(view) for field, view in state_slot.views.items()}
+        seq = 0
+        while not stopped.is_set():
+            if state_slot.seq != seq:
+                new_seq, scratch = state_slot.read(out=scratch, timeout=0.01)
+                if new_seq is not None:
+                    seq = new_seq
+                    state, scratch = scratch, state
+            if seq > 0:
+                update_fn(camera_feed, state)
+            camera_feed.update_window()
 
+    @staticmethod
+    def _draw_messages(camera_feed, queue, stopped, update_fn):
         # Main loop: draw user-defined elements
-        while True:
-            if not queue.empty():
-                msg = queue.get()
-                if msg is None:
-                    break
+        while not stopped.is_set():
+            try:
+                msg = queue.get(timeout=0.1)
+            except queue_module.Empty:
+                continue
+            if msg is None:
+                break
+            if not msg.get("start", False):
                 update_fn(camera_feed, msg)
                 camera_feed.update_window()
-            else:
-                time.sleep(0.01)
\ No newline at end of file
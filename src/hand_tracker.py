@@ -1,8 +1,13 @@
 from rgbd_stream import RGBDFrame
+from shared_slot import SharedSlot
+from camera import unproject
 import mediapipe as mp
+import multiprocessing
 import numpy as np
 import time
+import cv2
 from numpy.typing import NDArray
+from typing import Optional, Tuple
 
 
 class HandTracker:
@@ -47,3 +52,156 @@ class HandTracker:
         if len(self.hand_velocities) > 0:
             return self.hand_velocities[-1]
         return np.zeros(3)
+
+
+class HandTrackerProcess:
+    '''Runs hand tracking in a separate process; a drop-in for HandTracker
+    whose update() never waits for inference.
+
+    update() only downscales the RGB image to input_size (width, height) and
+    writes it, the depth image and the camera into a shared frame slot. The
+    worker always processes the newest frame and publishes the wrist
+    position, velocity and the capture time of the frame it was detected in
+    to a shared result slot, which the get_* methods read.
+    '''
+
+    def __init__(self, input_size: Tuple[int, int] = (320, 240)) -> None:
+        self.input_size = input_size
+        self.result = SharedSlot({
+            'position': ((3,), np.float64),
+            'velocity': ((3,), np.float64),
+            'timestamp': ((1,), np.float64),
+            'detection_count': ((1,), np.int64),
+        })
+        self.frame_slot = None
+        self.frame_ready = multiprocessing.Event()
+        self.stopped = multiprocessing.Event()
+        self.proc = None
+        # (seq, values) of the last consistent result and a scratch copy
+        # that the next read goes into
+        self._result = (0, {field: np.zeros_like(view) for field, view in self.result.views.items()})
+        self._scratch = {field: np.zeros_like(view) for field, view in self.result.views.items()}
+
+    def _start(self, frame: RGBDFrame) -> None:
+        width, height = self.input_size
+        self.frame_slot = SharedSlot({
+            'rgb': ((height, width, 3), np.uint8),
+            'depth': (frame.depth.shape, np.float32),
+            'screen_to_world': ((3, 4), np.float64),
+            'offset': ((2,), np.float64),
+            'perspective': ((1,), np.bool_),
+            'timestamp': ((1,), np.float64),
+        })
+        self.proc = multiprocessing.Process(
+            target=self._worker,
+            args=(self.frame_slot.spec(), self.result.spec(), self.frame_ready, self.stopped),
+            daemon=True)
+        self.proc.start()
+
+    def update(self, frame: RGBDFrame, timestamp: Optional[float] = None) -> None:
+        if timestamp is None:
+            timestamp = time.time()
+        if self.proc is None:
+            self._start(frame)
+
+        views = self.frame_slot.views
+        if views['depth'].shape != frame.depth.shape:
+            raise ValueError('Depth image size changed while hand tracking')
+        _, screen_to_world = frame.camera.get_matrices(frame.full_shape[1], frame.full_shape[0])
+
+        self.frame_slot.begin_write()
+        cv2.resize(frame.rgb_u8, self.input_size, dst=views['rgb'], interpolation=cv2.INTER_AREA)
+        np.copyto(views['depth'], frame.depth)
+        views['screen_to_world'][...] = screen_to_world
+        views['offset'][...] = frame.offset
+        views['perspective'][0] = not frame.camera.intrinsics.orthographic
+        views['timestamp'][0] = timestamp
+        self.frame_slot.end_write()
+        self.frame_ready.set()
+
+    def _read_result(self):
+        # A single attempt: if the worker is mid-write (or died mid-write),
+        # the previous result is returned instead of waiting.
+        if not self.result.is_current(self._result[0]):
+            seq, values = self.result.read(out=self._scratch, timeout=0)
+            if seq is not None:
+                self._scratch = self._result[1]
+                self._result = (seq, values)
+        return self._result[1]
+
+    def get_position(self) -> NDArray:
+        return self._read_result()['position'].copy()
+
+    def get_velocity(self) -> NDArray:
+        return self._read_result()['velocity'].copy()
+
+    def get_detection_time(self) -> Optional[float]:
+        '''Returns the capture time of the frame of the latest detection.'''
+        result = self._read_result()
+        if result['detection_count'][0] == 0:
+            return None
+        return float(result['timestamp'][0])
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.proc is not None:
+            self.proc.join()
+            self.proc = None
+        for slot in (self.frame_slot, self.result):
+            if slot is not None:
+                slot.close()
+        self.frame_slot = None
+
+    @staticmethod
+    def _worker(frame_spec, result_spec, frame_ready, stopped):
+        frame_slot = SharedSlot.attach(frame_spec)
+        result_slot = SharedSlot.attach(result_spec)
+        hand_detector = mp.solutions.hands.Hands(
+            static_image_mode=False,
+            max_num_hands=1,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5)
+
+        frame = None
+        seq = 0
+        last_position, last_time = None, None
+        detection_count = 0
+        try:
+            while not stopped.is_set():
+                if not frame_ready.wait(0.1):
+                    continue
+                frame_ready.clear()
+                if frame_slot.seq == seq:
+                    continue
+                new_seq, frame = frame_slot.read(out=frame, timeout=0.1)
+                if new_seq is None:
+                    # Torn by a write that did not finish; wait for the next.
+                    continue
+                seq = new_seq
+
+                results = hand_detector.process(frame['rgb'])
+                if not results.multi_hand_landmarks:
+                    continue
+                landmark = results.multi_hand_landmarks[0].landmark[mp.solutions.hands.HandLandmark.WRIST]
+                x, y = landmark.x, landmark.y
+                if not (x >= 0.0 and y >= 0.0 and x < 1.0 and y < 1.0):
+                    continue
+
+                depth = frame['depth']
+                height, width = depth.shape
+                offset_y, offset_x = frame['offset']
+                xyz = np.array([x * width + offset_x, y * height + offset_y, depth[int(y * height), int(x * width)]])
+                position = unproject(xyz, frame['screen_to_world'], bool(frame['perspective'][0]))
+                timestamp = frame['timestamp'][0]
+
+                velocity = np.zeros(3)
+                if last_position is not None and timestamp > last_time:
+                    velocity = (position - last_position) / (timestamp - last_time)
+                last_position, last_time = position, timestamp
+                detection_count += 1
+
+                result_slot.write(position=position, velocity=velocity,
+                                  timestamp=timestamp, detection_count=detection_count)
+        finally:
+            frame_slot.close()
+            result_slot.close()
@@ -0,0 +1,248 @@
+from typing import Optional, Tuple
+from numpy.typing import NDArray
+import numpy as np
+
+
+def kabsch_from_moments(centroid_P: NDArray, centroid_Q: NDArray, H: NDArray) -> Tuple[NDArray, NDArray]:
+    '''Returns the rotation R and translation t minimizing |R p + t - q|
+    over point pairs with the given centroids and cross-covariance H (sum of
+    outer products of the centered p and q).'''
+    U, S, Vt = np.linalg.svd(H)
+    R = Vt.T @ U.T
+
+    if np.linalg.det(R) < 0:
+        Vt[-1, :] *= -1
+        R = Vt.T @ U.T
+
+    t = centroid_Q - R @ centroid_P
+
+    return R, t
+
+
+def kabsch(P: NDArray, Q: NDArray) -> Tuple[NDArray, NDArray]:
+    centroid_P = np.mean(P, axis=0)
+    centroid_Q = np.mean(Q, axis=0)
+    H = (P - centroid_P).T @ (Q - centroid_Q)
+    return kabsch_from_moments(centroid_P, centroid_Q, H)
+
+
+def _kabsch_batch(P: NDArray, Q: NDArray) -> Tuple[NDArray, NDArray]:
+    '''kabsch() over a batch of (K, M, 3) point sets at once.'''
+    centroid_P = P.mean(axis=1)
+    centroid_Q = Q.mean(axis=1)
+    H = np.einsum('kmi,kmj->kij', P - centroid_P[:, None], Q - centroid_Q[:, None])
+    U, S, Vt = np.linalg.svd(H)
+    V = np.swapaxes(Vt, 1, 2)
+    d = np.sign(np.linalg.det(V @ np.swapaxes(U, 1, 2)))
+    V[:, :, -1] *= d[:, None]
+    R = V @ np.swapaxes(U, 1, 2)
+    t = centroid_Q - np.einsum('kij,kj->ki', R, centroid_P)
+    return R, t
+
+
+class IncrementalKabsch:
+    '''Fits the rigid transform q = R p + t to a stream of point pairs in O(1)
+    memory and time per pair.
+
+    Only running centroids and the 3x3 cross-covariance of accepted pairs
+    are kept, so solve() can produce a fit at any time. Until min_samples
+    pairs have been seen, pairs go to a reservoir only; RANSAC over the
+    reservoir then picks the initial inliers. After that, pairs further
+    than inlier_threshold from the current fit are rejected. Every
+    ransac_interval pairs, RANSAC runs again on the reservoir (a uniform
+    sample of all pairs seen, of at most reservoir_size) and restarts the
+    fit from its inliers if it explains clearly more of them.
+
+    Every check_interval accepted pairs, the fit is compared with the one
+    from the previous check; it has converged once it moved less than the
+    tolerances patience times in a row.
+
+    Pairs bunched in a small region or along a line leave the rotation
+    poorly determined however stable the fit looks, so neither RANSAC nor
+    convergence accept a set of p whose standard deviation along its
+    spread_axes-th principal axis is below min_spread (2 axes: the points
+    must not be collinear; 3: nor coplanar).
+    '''
+
+    def __init__(
+        self,
+        inlier_threshold: float = 0.01,
+        min_samples: int = 30,
+        reservoir_size: int = 256,
+        ransac_iterations: int = 128,
+        ransac_interval: int = 100,
+        check_interval: int = 25,
+        rotation_tolerance: float = 1e-3,
+        translation_tolerance: float = 5e-4,
+        patience: int = 3,
+        min_spread: float = 0.03,
+        spread_axes: int = 2,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.inlier_threshold = inlier_threshold
+        self.min_samples = min_samples
+        self.ransac_iterations = ransac_iterations
+        self.ransac_interval = ransac_interval
+        self.check_interval = check_interval
+        self.rotation_tolerance = rotation_tolerance
+        self.translation_tolerance = translation_tolerance
+        self.patience = patience
+        self.min_spread = min_spread
+        self.spread_axes = spread_axes
+        self.rng = np.random.default_rng(seed)
+
+        self.reservoir_P = np.empty((reservoir_size, 3))
+        self.reservoir_Q = np.empty((reservoir_size, 3))
+        self.seen_count = 0
+        self.rejected_count = 0
+
+        self._reset_moments()
+        self.converged = False
+        self._stable_checks = 0
+        self._last_check: Optional[Tuple[NDArray, NDArray]] = None
+
+    def _reset_moments(self) -> None:
+        self.count = 0
+        self.centroid_P = np.zeros(3)
+        self.centroid_Q = np.zeros(3)
+        self.H = np.zeros((3, 3))
+        # Scatter matrix of the accepted p, for their spread
+        self.S_P = np.zeros((3, 3))
+        self._fit: Optional[Tuple[NDArray, NDArray]] = None
+
+    @property
+    def reservoir_count(self) -> int:
+        return min(self.seen_count, len(self.reservoir_P))
+
+    def _accumulate(self, p: NDArray, q: NDArray) -> None:
+        self.count += 1
+        delta_P = p - self.centroid_P
+        delta_Q = q - self.centroid_Q
+        self.centroid_P += delta_P / self.count
+        self.centroid_Q += delta_Q / self.count
+        self.H += np.outer(delta_P, delta_Q) * ((self.count - 1) / self.count)
+        self.S_P += np.outer(delta_P, delta_P) * ((self.count - 1) / self.count)
+        self._fit = None
+
+    def _add_to_reservoir(self, p: NDArray, q: NDArray) -> None:
+        self.seen_count += 1
+        if self.seen_count <= len(self.reservoir_P):
+            index = self.seen_count - 1
+        else:
+            index = int(self.rng.integers(self.seen_count))
+            if index >= len(self.reservoir_P):
+                return
+        self.reservoir_P[index] = p
+        self.reservoir_Q[index] = q
+
+    @staticmethod
+    def _principal_spread(covariance: NDArray) -> NDArray:
+        return np.sqrt(np.clip(np.linalg.eigvalsh(covariance)[::-1], 0.0, None))
+
+    def _is_spread(self, P: NDArray) -> bool:
+        return len(P) >= 3 and self._principal_spread(np.cov(P.T, bias=True))[self.spread_axes - 1] >= self.min_spread
+
+    @property
+    def spread(self) -> NDArray:
+        '''Standard deviations of the accepted p along their principal
+        axes, largest first.'''
+        if self.count == 0:
+            return np.zeros(3)
+        return self._principal_spread(self.S_P / self.count)
+
+    def is_well_spread(self) -> bool:
+        return self.spread[self.spread_axes - 1] >= self.min_spread
+
+    def _residuals(self, R: NDArray, t: NDArray, P: NDArray, Q: NDArray) -> NDArray:
+        return np.linalg.norm(P @ R.T + t - Q, axis=-1)
+
+    def ransac(self) -> NDArray:
+        '''Returns the inlier mask of the reservoir pairs under the best
+        transform fitted to random triples of them.'''
+        n = self.reservoir_count
+        P, Q = self.reservoir_P[:n], self.reservoir_Q[:n]
+        samples = np.argsort(self.rng.random((self.ransac_iterations, n)), axis=1)[:, :3]
+        R, t = _kabsch_batch(P[samples], Q[samples])
+        residuals = np.linalg.norm(np.einsum('kij,mj->kmi', R, P) + t[:, None] - Q, axis=-1)
+        inlier_counts = (residuals < self.inlier_threshold).sum(axis=1)
+        return residuals[np.argmax(inlier_counts)] < self.inlier_threshold
+
+    def _restart_from_reservoir(self, inliers: NDArray) -> None:
+        self._reset_moments()
+        n = self.reservoir_count
+        for p, q in zip(self.reservoir_P[:n][inliers], self.reservoir_Q[:n][inliers]):
+            self._accumulate(p, q)
+        self._stable_checks = 0
+        self._last_check = None
+        self.converged = False
+
+    def add(self, p: NDArray, q: NDArray) -> bool:
+        '''Adds the pair and returns whether it was accepted as an inlier.'''
+        p = np.asarray(p, dtype=np.float64)
+        q = np.asarray(q, dtype=np.float64)
+        self._add_to_reservoir(p, q)
+
+        if self.count == 0:
+            # Bootstrapping: wait for enough pairs, spread widely enough, to
+            # run RANSAC on.
+            n = self.reservoir_count
+            if n >= self.min_samples and self._is_spread(self.reservoir_P[:n]):
+                inliers = self.ransac()
+                if self._is_spread(self.reservoir_P[:n][inliers]):
+                    self._restart_from_reservoir(inliers)
+            return False
+
+        R, t = self.solve()
+        if np.linalg.norm(R @ p + t - q) > self.inlier_threshold:
+            self.rejected_count += 1
+            accepted = False
+        else:
+            self._accumulate(p, q)
+            accepted = True
+
+        if self.seen_count % self.ransac_interval == 0:
+            n = self.reservoir_count
+            inliers = self.ransac()
+            R, t = self.solve()
+            current = self._residuals(R, t, self.reservoir_P[:n], self.reservoir_Q[:n]) < self.inlier_threshold
+            if (np.count_nonzero(inliers) > 1.2 * np.count_nonzero(current)
+                    and self._is_spread(self.reservoir_P[:n][inliers])):
+                self._restart_from_reservoir(inliers)
+                return accepted
+
+        if accepted and self.count % self.check_interval == 0:
+            self._check_convergence()
+        return accepted
+
+    def _check_convergence(self) -> None:
+        R, t = self.solve()
+        if self._last_check is not None:
+            last_R, last_t = self._last_check
+            cos_angle = np.clip((np.trace(last_R.T @ R) - 1.0) / 2.0, -1.0, 1.0)
+            if (np.arccos(cos_angle) < self.rotation_tolerance
+                    and np.linalg.norm(t - last_t) < self.translation_tolerance):
+                self._stable_checks += 1
+            else:
+                self._stable_checks = 0
+        if not self.is_well_spread():
+            # Stability of a fit to bunched or collinear points means little.
+            self._stable_checks = 0
+        self._last_check = (R, t)
+        self.converged = self.count >= self.min_samples and self._stable_checks >= self.patience
+
+    def solve(self) -> Tuple[NDArray, NDArray]:
+        '''Returns the current fit (R, t) of the accepted pairs.'''
+        if self.count < 3:
+            raise ValueError('Not enough accepted point pairs to fit a transform')
+        if self._fit is None:
+            self._fit = kabsch_from_moments(self.centroid_P, self.centroid_Q, self.H)
+        return self._fit
+
+    def get_matrix(self) -> NDArray:
+        rotation, translation = self.solve()
+
+        matrix = np.eye(4)
+        matrix[0:3, 0:3] = rotation
+        matrix[0:3, 3] = translation
+
+        return matrix
@@ -0,0 +1,155 @@
+from __future__ import annotations
+from rgbd_stream import RGBDFrame
+from numpy.typing import NDArray
+import numpy as np
+from typing import Dict, Optional, Tuple
+import cv2
+
+
+class MarkerTracker:
+    '''Finds a colored marker in RGBD frames, searching only a window around
+    the previous detection.
+
+    The search works on depth pixels, with RGB sampled at their centers as
+    uint8, so nothing is resized or converted to float. When the marker is
+    lost, every coarse_step-th depth pixel of the whole frame is searched
+    and the window is re-centered on what was found.
+
+    A pixel matches if its squared RGB distance to marker_color (both in
+    [0, 1]) is below threshold, or, with use_in_range, if every channel is
+    within sqrt(threshold) of it (cv2.inRange, a cube instead of a sphere).
+
+    If the matches touch the edge of the window, part of the marker may lie
+    outside it and bias the centroid, so the window is grown around the
+    matches and searched again, up to max_expansions times; a marker still
+    cut off after that is reported as not found.
+    '''
+
+    def __init__(
+        self,
+        marker_color: NDArray,
+        threshold: float = 0.03,
+        window_radius: int = 24,
+        coarse_step: int = 4,
+        use_in_range: bool = False,
+        max_expansions: int = 3,
+    ) -> None:
+        self.marker_color = np.asarray(marker_color)
+        self.window_radius = window_radius
+        self.coarse_step = coarse_step
+        self.use_in_range = use_in_range
+        self.max_expansions = max_expansions
+
+        self._color = np.round(self.marker_color * 255.0).astype(np.int32)
+        self._threshold = int(threshold * 255.0 * 255.0)
+        radius = np.sqrt(threshold) * 255.0
+        self._lower = np.clip(np.ceil(self._color - radius), 0, 255).astype(np.uint8)
+        self._upper = np.clip(np.floor(self._color + radius), 0, 255).astype(np.uint8)
+
+        # (top, bottom, left, right) depth pixel bounds of the search window
+        self.window: Optional[Tuple[int, int, int, int]] = None
+        # The window searched by the last find(), which its mask covers
+        self.search_window: Optional[Tuple[int, int, int, int]] = None
+        # Mapping: (RGB shape, depth shape) -> (RGB row of each depth row, RGB column of each depth column)
+        self._sample_maps: Dict[Tuple, Tuple[NDArray, NDArray]] = {}
+
+    def _get_sample_maps(self, frame: RGBDFrame) -> Tuple[NDArray, NDArray]:
+        rgb_shape, depth_shape = frame.rgb_u8.shape[:2], frame.depth.shape
+        key = (rgb_shape, depth_shape)
+        maps = self._sample_maps.get(key)
+        if maps is None:
+            rows = ((np.arange(depth_shape[0]) + 0.5) * rgb_shape[0] / depth_shape[0]).astype(np.intp)
+            columns = ((np.arange(depth_shape[1]) + 0.5) * rgb_shape[1] / depth_shape[1]).astype(np.intp)
+            maps = (rows, columns)
+            self._sample_maps[key] = maps
+        return maps
+
+    def _match(self, rgb: NDArray) -> NDArray:
+        if self.use_in_range:
+            return cv2.inRange(rgb, self._lower, self._upper) > 0
+        difference = rgb.astype(np.int32)
+        difference -= self._color
+        difference *= difference
+        return difference.sum(axis=-1) < self._threshold
+
+    def _search(self, frame: RGBDFrame, rows: slice, columns: slice) -> Tuple[NDArray, NDArray, NDArray]:
+        '''Returns the mask of matching depth pixels in the given ranges and
+        their depth pixel coordinates.'''
+        row_map, column_map = self._get_sample_maps(frame)
+        rgb = frame.rgb_u8[row_map[rows][:, None], column_map[columns]]
+        mask = self._match(rgb)
+        indices_y, indices_x = np.nonzero(mask)
+        return mask, indices_y * (rows.step or 1) + rows.start, indices_x * (columns.step or 1) + columns.start
+
+    def _window_around(self, frame: RGBDFrame, indices_y: NDArray, indices_x: NDArray) -> Tuple[int, int, int, int]:
+        '''Returns the window spanning the given pixels plus window_radius
+        on every side.'''
+        height, width = frame.depth.shape
+        r = self.window_radius
+        return (max(int(indices_y.min()) - r, 0), min(int(indices_y.max()) + 1 + r, height),
+                max(int(indices_x.min()) - r, 0), min(int(indices_x.max()) + 1 + r, width))
+
+    @staticmethod
+    def _touches_border(frame: RGBDFrame, window: Tuple[int, int, int, int], mask: NDArray) -> bool:
+        '''Whether matches lie on an edge of the window that is not an edge
+        of the image.'''
+        height, width = frame.depth.shape
+        top, bottom, left, right = window
+        return bool((top > 0 and mask[0].any()) or (bottom < height and mask[-1].any())
+                    or (left > 0 and mask[:, 0].any()) or (right < width and mask[:, -1].any()))
+
+    def find(self, frame: RGBDFrame) -> Tuple[Optional[NDArray], NDArray]:
+        '''Returns the marker's world position (None if not found) and the
+        match mask of the searched window (see self.search_window).'''
+        if self.window is None:
+            height, width = frame.depth.shape
+            _, indices_y, indices_x = self._search(
+                frame, slice(0, height, self.coarse_step), slice(0, width, self.coarse_step))
+            if len(indices_x) == 0:
+                self.search_window = None
+                return None, np.zeros((0, 0), dtype=bool)
+            self.window = self._window_around(frame, indices_y, indices_x)
+
+        window = self.window
+        for _ in range(self.max_expansions + 1):
+            top, bottom, left, right = self.search_window = window
+            mask, indices_y, indices_x = self._search(frame, slice(top, bottom), slice(left, right))
+            if len(indices_x) == 0:
+                self.window = None
+                return None, mask
+            if not self._touches_border(frame, window, mask):
+                break
+            window = self._window_around(frame, indices_y, indices_x)
+        else:
+            # Still cut off by the window: the centroid would be biased.
+            self.window = None
+            return None, mask
+
+        xyz = np.empty((len(indices_x), 3))
+        xyz[:, 0] = indices_x + 0.5
+        xyz[:, 1] = indices_y + 0.5
+        xyz[:, 2] = frame.depth[indices_y, indices_x]
+        marker_points = frame.camera.screen_to_world(xyz, width=frame.depth.shape[1], height=frame.depth.shape[0])
+
+        # Follow the marker for the next frame.
+        self.window = self._window_around(frame, indices_y, indices_x)
+        return np.mean(marker_points, axis=0), mask
+
+    def draw(self, frame: RGBDFrame, mask: NDArray) -> NDArray:
+        '''Returns a BGR uint8 image of frame with the pixels matched by the
+        last find() blacked out and the searched window outlined.'''
+        bgr = cv2.cvtColor(frame.rgb_u8, cv2.COLOR_RGB2BGR)
+        window = self.search_window
+        if window is None or mask.size == 0:
+            return bgr
+
+        scale_y = bgr.shape[0] / frame.depth.shape[0]
+        scale_x = bgr.shape[1] / frame.depth.shape[1]
+        top, bottom, left, right = (int(round(window[0] * scale_y)), int(round(window[1] * scale_y)),
+                                    int(round(window[2] * scale_x)), int(round(window[3] * scale_x)))
+        region = bgr[top:bottom, left:right]
+        region_mask = cv2.resize(mask.astype(np.uint8), (region.shape[1], region.shape[0]),
+                                 interpolation=cv2.INTER_NEAREST)
+        region[region_mask > 0] = 0
+        cv2.rectangle(bgr, (left, top), (right, bottom), color=(0, 0, 255), thickness=2)
+        return bgr
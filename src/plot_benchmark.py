@@ -0,0 +1,142 @@
+'''Load generator and throughput benchmark for the plot service.
+
+Starts a headless PlotService (Agg backend) and drives it with synthetic
+PlotClients in separate processes, then reports the server's message rate,
+queue depth, redraw time and the latency from send to the render showing
+the update. Example:
+
+    python plot_benchmark.py --clients 2 --plots 11 --lines 3 --rate 30 --workload mixed
+'''
+import matplotlib
+matplotlib.use('Agg')
+
+from plot_client import PlotClient
+import plot_server
+import multiprocessing as mp
+import numpy as np
+import argparse
+import threading
+import time
+import os
+
+WORKLOADS = ('append', 'replace', 'config', 'mixed')
+
+
+def _run_client(address, args, client_index, results):
+    client = PlotClient(
+        address,
+        asynchronous=args.async_client,
+        shared_memory_threshold=args.shared_memory_threshold,
+        timestamp_messages=True)
+
+    plot_ids = [f'{client_index:02d}_{i:02d}' for i in range(args.plots)]
+    line_ids = [f'line_{j}' for j in range(args.lines)]
+    for plot_id in plot_ids:
+        client.create_plot(plot_id, title=plot_id, xlabel='Time (s)')
+        for line_id in line_ids:
+            client.create_line(plot_id, line_id, label=line_id)
+
+    replace_x = np.linspace(0.0, 1.0, args.replace_size)
+    send_time = 0.0
+    ticks = 0
+    start = time.monotonic()
+    while True:
+        t = time.monotonic() - start
+        if t >= args.duration:
+            break
+
+        send_start = time.perf_counter()
+        for i, plot_id in enumerate(plot_ids):
+            if args.workload == 'append' or (args.workload == 'mixed' and i % 2 == 0):
+                for j, line_id in enumerate(line_ids):
+                    client.update_line(plot_id, line_id, (t, np.sin(t + j)))
+                client.config_plot(plot_id, xlim=(t - args.window, t))
+            elif args.workload in ('replace', 'mixed'):
+                for j, line_id in enumerate(line_ids):
+                    client.update_line(
+                        plot_id, line_id, (replace_x, np.sin(replace_x * 10.0 + t + j)), mode='replace')
+            elif args.workload == 'config':
+                client.config_plot(plot_id, xlim=(t - args.window, t), ylim=(-1.0, 1.0))
+        send_time += time.perf_counter() - send_start
+        ticks += 1
+
+        next_tick = start + ticks / args.rate
+        time.sleep(max(next_tick - time.monotonic(), 0.0))
+
+    stats = client.get_stats()
+    stats['send_time_per_tick'] = send_time / max(ticks, 1)
+    client.close()
+    results.put(stats)
+
+
+def _format(summary):
+    def seconds(stats, scale=1000.0, unit='ms'):
+        if not stats:
+            return 'n/a'
+        return ' '.join(f'{key}={value * scale:.2f}{unit}' for key, value in stats.items())
+
+    def count(stats):
+        if not stats:
+            return 'n/a'
+        return ' '.join(f'{key}={value:.1f}' for key, value in stats.items())
+
+    return '\n'.join([
+        f"messages:      {summary['messages']} ({summary['messages_per_second']:.0f}/s)",
+        f"frames:        {summary['frames']} ({summary['frames_per_second']:.1f}/s)",
+        f"queue depth:   {count(summary['queue_depth'])}",
+        f"redraw time:   {seconds(summary['redraw_time'])}",
+        f"latency:       {seconds(summary['latency'])}",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--plots', type=int, default=11, help='plots per client')
+    parser.add_argument('--lines', type=int, default=3, help='lines per plot')
+    parser.add_argument('--rate', type=float, default=30.0, help='update ticks per second per client')
+    parser.add_argument('--workload', choices=WORKLOADS, default='append',
+                        help='scalar appends, bulk replaces, config spam, or appends and replaces mixed')
+    parser.add_argument('--replace-size', type=int, default=256, help='samples per replace update')
+    parser.add_argument('--window', type=float, default=5.0, help='sliding xlim width in seconds')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds each client sends for')
+    parser.add_argument('--max-fps', type=float, default=30.0)
+    parser.add_argument('--async-client', action='store_true')
+    parser.add_argument('--shared-memory-threshold', type=int, default=None)
+    args = parser.parse_args()
+
+    address = None if os.name == 'nt' else f'/tmp/plot_benchmark_{os.getpid()}.sock'
+    service = plot_server.PlotService(address, max_fps=args.max_fps, collect_stats=True)
+    address = service.address
+    threading.Thread(target=service.accept_clients, daemon=True).start()
+
+    results = mp.Queue()
+    clients = [mp.Process(target=_run_client, args=(address, args, i, results))
+               for i in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    def stop_when_done():
+        for client in clients:
+            client.join()
+        # Let the service render what is still queued.
+        time.sleep(1.0)
+        service.stop()
+
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    service.stats.reset()
+    service.run_plot_loop()
+
+    summary = service.stats.summary()
+    client_stats = [results.get() for _ in clients]
+
+    print(f'{args.clients} client(s), {args.plots} plot(s) x {args.lines} line(s), '
+          f'{args.workload} at {args.rate:g} Hz for {args.duration:g} s')
+    print(_format(summary))
+    for i, stats in enumerate(client_stats):
+        print(f"client {i}:      sent={stats['sent']} dropped={stats['dropped']} merged={stats['merged']} "
+              f"send time/tick={stats['send_time_per_tick'] * 1000.0:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
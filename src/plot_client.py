@@ -1,29 +1,198 @@
 from multiprocessing.connection import Client
+from collections import deque
+from shared_slot import SharedSlot
+import numpy as np
+import threading
+import time
 import os
 
+# Actions whose messages may be dropped or merged when the send queue is full.
+# Structural messages (create/remove) and replace updates are always
+# delivered, the latter unless superseded by a newer replace.
+_DROPPABLE_ACTIONS = ("update", "update_line", "config", "config_line")
+
+
+def _message_key(msg):
+    return msg["action"], msg.get("plot_id"), msg.get("line_id")
+
+
+def _is_replace(msg):
+    return msg["action"] in ("update", "update_line") and msg.get("mode") == "replace"
+
 
 class PlotClient:
-    def __init__(self, address=None, authkey=b'secret password'):
+    def __init__(self, address=None, authkey=b'secret password', asynchronous=False, max_queue_size=256,
+                 shared_memory_threshold=None, timestamp_messages=False):
         if address is None:
             address = r'\\.\pipe\plot_service' if os.name == 'nt' else '/tmp/plot_service.sock'
         self.conn = Client(address, authkey=authkey)
 
+        self.asynchronous = asynchronous
+        self.max_queue_size = max_queue_size
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.merged_count = 0
+
+        # Replace updates of (x, y) arrays with at least this many samples are
+        # written to shared memory instead of being pickled.
+        self.shared_memory_threshold = shared_memory_threshold
+        # Mapping: (plot_id, line_id) -> SharedSlot
+        self._shared_slots = {}
+        self._retired_slots = []
+        # Stamp each message with its send time so the server can measure
+        # end-to-end latency.
+        self.timestamp_messages = timestamp_messages
+
+        if self.asynchronous:
+            self._queue = deque()
+            self._queue_condition = threading.Condition()
+            self._closing = False
+            self._sender_thread = threading.Thread(
+                target=self._sender_loop, daemon=True)
+            self._sender_thread.start()
+
+    @property
+    def queued_count(self):
+        if not self.asynchronous:
+            return 0
+        with self._queue_condition:
+            return len(self._queue)
+
+    def get_stats(self):
+        return {
+            "sent": self.sent_count,
+            "dropped": self.dropped_count,
+            "merged": self.merged_count,
+            "queued": self.queued_count,
+        }
+
+    def _send(self, msg):
+        if self.timestamp_messages:
+            msg["sent_at"] = time.time()
+        if not self.asynchronous:
+            self.conn.send(msg)
+            self.sent_count += 1
+            return
+
+        with self._queue_condition:
+            if len(self._queue) >= self.max_queue_size and not self._make_room(msg):
+                return
+            self._queue.append(msg)
+            self._queue_condition.notify()
+
+    def _make_room(self, msg):
+        # Called with the queue full. Returns whether msg still needs to be
+        # appended. Replace updates (including shared-memory ones) carry a
+        # line's whole data, so like structural messages they are never
+        # dropped, only superseded by a newer replace of the same line. The
+        # queue grows past max_queue_size only when it holds nothing else.
+        if msg["action"] in ("config", "config_line") or _is_replace(msg):
+            # Merge into the newest queued message for the same plot/line, in
+            # its place, unless a structural message for the plot follows it.
+            key = _message_key(msg)
+            for i in range(len(self._queue) - 1, -1, -1):
+                queued = self._queue[i]
+                if queued["action"] not in _DROPPABLE_ACTIONS:
+                    if queued.get("plot_id") == msg.get("plot_id"):
+                        break
+                    continue
+                if _message_key(queued) != key:
+                    continue
+                if msg["action"] in ("config", "config_line"):
+                    self._queue[i] = dict(msg, options={**queued["options"], **msg["options"]})
+                    self.merged_count += 1
+                else:
+                    self._queue[i] = msg
+                    self.dropped_count += 1
+                return False
+
+        for i, queued in enumerate(self._queue):
+            if queued["action"] in _DROPPABLE_ACTIONS and not _is_replace(queued):
+                del self._queue[i]
+                self.dropped_count += 1
+                return True
+
+        if msg["action"] in _DROPPABLE_ACTIONS and not _is_replace(msg):
+            self.dropped_count += 1
+            return False
+        return True
+
+    def _sender_loop(self):
+        while True:
+            with self._queue_condition:
+                while not self._queue and not self._closing:
+                    self._queue_condition.wait()
+                if not self._queue:
+                    return
+                msg = self._queue.popleft()
+            try:
+                self.conn.send(msg)
+            except (OSError, EOFError) as e:
+                print("Plot client sender stopped:", e)
+                return
+            self.sent_count += 1
+
     def create_plot(self, plot_id, **options):
         msg = {
             "action": "create",
             "plot_id": plot_id,
             "options": options,
         }
-        self.conn.send(msg)
+        self._send(msg)
+
+    def _use_shared_memory(self, data, mode):
+        if self.shared_memory_threshold is None or mode != "replace":
+            return False
+        if not isinstance(data, tuple) or len(data) != 2:
+            return False
+        x, y = data
+        return (isinstance(x, np.ndarray) and isinstance(y, np.ndarray) and
+                x.ndim == 1 and x.shape == y.shape and
+                x.size >= self.shared_memory_threshold)
+
+    def _send_shared(self, action, plot_id, line_id, data):
+        x, y = data
+        key = (plot_id, line_id)
+        slot = self._shared_slots.get(key)
+        if slot is None or slot.views["x"].size < x.size:
+            if slot is not None:
+                # The server may still be reading the old slot.
+                self._retired_slots.append(slot)
+            capacity = 1 << int(x.size - 1).bit_length()
+            slot = SharedSlot({
+                "length": ((1,), np.int64),
+                "x": ((capacity,), np.float64),
+                "y": ((capacity,), np.float64),
+            })
+            self._shared_slots[key] = slot
+
+        slot.begin_write()
+        slot.views["length"][0] = x.size
+        slot.views["x"][:x.size] = x
+        slot.views["y"][:y.size] = y
+        slot.end_write()
+
+        msg = {
+            "action": action,
+            "plot_id": plot_id,
+            "shared": slot.spec(),
+            "mode": "replace",
+        }
+        if action == "update_line":
+            msg["line_id"] = line_id
+        self._send(msg)
 
     def update_plot(self, plot_id, data, mode="append"):
+        if self._use_shared_memory(data, mode):
+            self._send_shared("update", plot_id, "default", data)
+            return
         msg = {
             "action": "update",
             "plot_id": plot_id,
             "data": data,
             "mode": mode,
         }
-        self.conn.send(msg)
+        self._send(msg)
 
     def config_plot(self, plot_id, **options):
         msg = {
@@ -31,14 +200,14 @@ class PlotClient:
             "plot_id": plot_id,
             "options": options,
         }
-        self.conn.send(msg)
+        self._send(msg)
 
     def remove_plot(self, plot_id):
         msg = {
             "action": "remove",
             "plot_id": plot_id,
         }
-        self.conn.send(msg)
+        self._send(msg)
 
     def create_line(self, plot_id, line_id, **options):
         msg = {
@@ -47,9 +216,12 @@ class PlotClient:
             "line_id": line_id,
             "options": options,
         }
-        self.conn.send(msg)
+        self._send(msg)
 
     def update_line(self, plot_id, line_id, data, mode="append"):
+        if self._use_shared_memory(data, mode):
+            self._send_shared("update_line", plot_id, line_id, data)
+            return
         msg = {
             "action": "update_line",
             "plot_id": plot_id,
@@ -57,7 +229,7 @@ class PlotClient:
             "data": data,
             "mode": mode,
         }
-        self.conn.send(msg)
+        self._send(msg)
 
     def config_line(self, plot_id, line_id, **options):
         msg = {
@@ -66,7 +238,7 @@ class PlotClient:
             "line_id": line_id,
             "options": options,
         }
-        self.conn.send(msg)
+        self._send(msg)
 
     def remove_line(self, plot_id, line_id):
         msg = {
@@ -74,7 +246,16 @@ class PlotClient:
             "plot_id": plot_id,
             "line_id": line_id,
         }
-        self.conn.send(msg)
+        self._send(msg)
 
     def close(self):
+        if self.asynchronous:
+            with self._queue_condition:
+                self._closing = True
+                self._queue_condition.notify()
+            self._sender_thread.join()
         self.conn.close()
+        for slot in list(self._shared_slots.values()) + self._retired_slots:
+            slot.close()
+        self._shared_slots = {}
+        self._retired_slots = []
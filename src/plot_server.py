@@ -1,23 +1,290 @@
 import os
 import threading
 import queue
+import time
+from collections import deque
+import matplotlib.image
 import matplotlib.pyplot as plt
+import multiprocessing as mp
 import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+from matplotlib.transforms import Bbox, IdentityTransform
 from multiprocessing.connection import Listener
+from shared_slot import SharedSlot
 import math
 
 command_queue = queue.Queue()
 client_windows = {}
 
 
+def _option_equal(a, b):
+    try:
+        return bool(a == b)
+    except ValueError:
+        return np.array_equal(a, b)
+
+
+def _is_scalar(value):
+    return isinstance(value, (int, float, np.number))
+
+
+# Line/plot options that select the ring-buffer history backend.
+HISTORY_OPTIONS = ("capacity", "x_window", "max_capacity")
+# Line options that may also be given at plot level for all of its lines.
+INHERITED_LINE_OPTIONS = HISTORY_OPTIONS + ("decimation",)
+# Seconds the render path waits for a client stuck mid-write to a shared
+# slot before drawing the last consistent data instead.
+SHARED_READ_TIMEOUT = 0.01
+
+
+def minmax_decimate(x, y, n_bins):
+    """Keeps the minimum and maximum of y in each of n_bins equal-count bins,
+    so no visible peak is lost. x must be sorted."""
+    n = len(x)
+    if n <= 2 * n_bins:
+        return x, y
+    chunk = -(-n // n_bins)
+    rows = -(-n // chunk)
+    padded = np.empty(rows * chunk)
+    padded[:n] = y
+    padded[n:] = y[-1]
+    padded = padded.reshape(rows, chunk)
+    offsets = np.arange(rows) * chunk
+    indices = np.concatenate([
+        [0], offsets + np.argmin(padded, axis=1),
+        offsets + np.argmax(padded, axis=1), [n - 1]])
+    indices = np.unique(np.minimum(indices, n - 1))
+    return x[indices], y[indices]
+
+
+def lttb_decimate(x, y, n_out):
+    """Largest-Triangle-Three-Buckets downsampling to n_out points. x must be
+    sorted."""
+    n = len(x)
+    if n <= n_out or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    selected = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        ax, ay = x[selected], y[selected]
+        areas = np.abs((ax - next_x) * (y[start:end] - ay) -
+                       (ax - x[start:end]) * (next_y - ay))
+        selected = start + int(np.argmax(areas))
+        indices[i + 1] = selected
+    return x[indices], y[indices]
+
+
+DECIMATORS = {
+    "minmax": minmax_decimate,
+    "lttb": lttb_decimate,
+}
+
+
+class RingBuffer:
+    """Preallocated x/y history of at most `capacity` points.
+
+    Every sample is written twice, `capacity` elements apart, so the live
+    window is always one contiguous slice and get_data() returns views.
+    With `x_window`, points older than the newest x minus the window are
+    discarded and the capacity doubles (up to `max_capacity`) whenever the
+    window holds more points than fit.
+    """
+
+    DEFAULT_CAPACITY = 1024
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, x_window=None, max_capacity=1 << 20):
+        self.capacity = int(capacity)
+        self.x_window = x_window
+        self.max_capacity = max(int(max_capacity), self.capacity)
+        self._x = np.empty(2 * self.capacity)
+        self._y = np.empty(2 * self.capacity)
+        self.start = 0
+        self.size = 0
+        # Total number of samples ever appended, used as x for bare values.
+        self.count = 0
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+        self.count = 0
+
+    def get_data(self):
+        end = self.start + self.size
+        return self._x[self.start:end], self._y[self.start:end]
+
+    def _drop_oldest(self, n):
+        self.start = (self.start + n) % self.capacity
+        self.size -= n
+
+    def _trim_window(self, newest_x):
+        cutoff = newest_x - self.x_window
+        if self.size == 0 or self._x[self.start] >= cutoff:
+            return
+        x, _ = self.get_data()
+        self._drop_oldest(int(np.searchsorted(x, cutoff)))
+
+    def _grow(self, min_capacity):
+        capacity = self.capacity
+        while capacity < min_capacity and capacity < self.max_capacity:
+            capacity *= 2
+        capacity = min(capacity, self.max_capacity)
+        if capacity == self.capacity:
+            return
+        x, y = self.get_data()
+        self._x = np.empty(2 * capacity)
+        self._y = np.empty(2 * capacity)
+        self._x[:self.size] = self._x[capacity:capacity + self.size] = x
+        self._y[:self.size] = self._y[capacity:capacity + self.size] = y
+        self.capacity = capacity
+        self.start = 0
+
+    def append(self, x, y):
+        if self.x_window is not None:
+            self._trim_window(x)
+            if self.size == self.capacity:
+                self._grow(self.capacity + 1)
+        if self.size == self.capacity:
+            self._drop_oldest(1)
+        i = (self.start + self.size) % self.capacity
+        self._x[i] = self._x[i + self.capacity] = x
+        self._y[i] = self._y[i + self.capacity] = y
+        self.size += 1
+        self.count += 1
+
+    def extend(self, xs, ys):
+        xs = np.asarray(xs, dtype=float).ravel()
+        ys = np.asarray(ys, dtype=float).ravel()
+        self.count += len(xs)
+        if len(xs) == 0:
+            return
+        if self.x_window is not None:
+            self._trim_window(xs[-1])
+            first = int(np.searchsorted(xs, xs[-1] - self.x_window))
+            xs, ys = xs[first:], ys[first:]
+            self._grow(self.size + len(xs))
+        if len(xs) > self.capacity:
+            xs, ys = xs[-self.capacity:], ys[-self.capacity:]
+        overflow = self.size + len(xs) - self.capacity
+        if overflow > 0:
+            self._drop_oldest(overflow)
+
+        n = len(xs)
+        capacity = self.capacity
+        i = (self.start + self.size) % capacity
+        head = min(n, capacity - i)
+        for buffer, values in ((self._x, xs), (self._y, ys)):
+            buffer[i:i + head] = buffer[i + capacity:i + capacity + head] = values[:head]
+            buffer[:n - head] = buffer[capacity:capacity + n - head] = values[head:]
+        self.size += n
+
+
 class LineEntry:
     def __init__(self, options=None):
         self.options = options or {}
         self.data = None
         self.x_data = None
         self.y_data = None
+        self.history = self._make_history()
+        # SharedSlot holding the line's arrays when they are streamed
+        # through shared memory.
+        self.shared = None
+        # (seq, x, y) last consistent copy of the shared arrays
+        self._shared_copy = None
+        self.artist = None
+        # Set whenever the data or style changes, cleared once rendered.
+        self.dirty = True
+        # Bumped on every data change; keys the decimation cache.
+        self.version = 0
+        self._sorted_version = None
+        self._is_sorted = False
+        self._display_cache_key = None
+        self._display_cache = None, None
+
+    def _make_history(self):
+        capacity = self.options.get("capacity")
+        x_window = self.options.get("x_window")
+        if capacity is None and x_window is None:
+            return None
+        return RingBuffer(capacity or RingBuffer.DEFAULT_CAPACITY, x_window,
+                          self.options.get("max_capacity", 1 << 20))
+
+    def _update_history(self, new_data, mode):
+        if mode == "replace":
+            self.history.clear()
+
+        if isinstance(new_data, tuple) and len(new_data) == 2:
+            x, y = new_data
+            if _is_scalar(x) and _is_scalar(y):
+                self.history.append(x, y)
+            elif not _is_scalar(x) and not _is_scalar(y):
+                # Whole arrays replace the line, as with the list backend,
+                # but are kept as arrays instead of Python lists.
+                self.history.clear()
+                self.x_data = np.asarray(x, dtype=float)
+                self.y_data = np.asarray(y, dtype=float)
+                return True
+            else:
+                return False
+        elif _is_scalar(new_data):
+            self.history.append(self.history.count, new_data)
+        else:
+            return False
+
+        self.data = None
+        self.x_data = None
+        self.y_data = None
+        return True
+
+    def update_shared(self, slot):
+        self.version += 1
+        self.dirty = True
+        if slot is not self.shared:
+            self._shared_copy = None
+        self.shared = slot
+        self.data = None
+        self.x_data = None
+        self.y_data = None
+        if self.history is not None:
+            self.history.clear()
+
+    def _extend(self, xs, ys):
+        if self.history is not None:
+            if xs is None:
+                xs = np.arange(self.history.count, self.history.count + len(ys))
+            self.history.extend(xs, ys)
+            self.data = None
+            self.x_data = None
+            self.y_data = None
+            return
+        if self.data is None:
+            self.data = []
+        if xs is None:
+            self.data.extend(np.asarray(ys).tolist())
+        else:
+            self.data.extend(zip(np.asarray(xs).tolist(), np.asarray(ys).tolist()))
 
     def update_data(self, new_data, mode="append"):
+        self.version += 1
+        self.dirty = True
+        self.shared = None
+        self._shared_copy = None
+        if mode == "extend":
+            # Several appended points at once, as (xs, ys) with xs None for
+            # bare values.
+            self._extend(*new_data)
+            return
+        if self.history is not None and self._update_history(new_data, mode):
+            return
+
         if mode == "replace":
             self.data = None
             self.x_data = None
@@ -68,10 +335,21 @@ class LineEntry:
 
     def update_config(self, options):
         self.options.update(options)
+        self.version += 1
+        self.dirty = True
+        if any(key in options for key in HISTORY_OPTIONS):
+            old_history = self.history
+            self.history = self._make_history()
+            if old_history is not None and self.history is not None:
+                self.history.extend(*old_history.get_data())
 
     def get_data(self):
-        if self.x_data is not None and self.y_data is not None:
-            return np.array(self.x_data), np.array(self.y_data)
+        if self.shared is not None:
+            return self._get_shared_data()
+        elif self.x_data is not None and self.y_data is not None:
+            return np.asarray(self.x_data), np.asarray(self.y_data)
+        elif self.history is not None and self.history.size > 0:
+            return self.history.get_data()
         elif self.data is not None:
             if len(self.data) > 0 and isinstance(self.data[0], (list, tuple)):
                 data_arr = np.array(self.data)
@@ -84,71 +362,279 @@ class LineEntry:
         else:
             return None, None
 
+    def _get_shared_data(self):
+        # Copies the arrays out of shared memory (one memcpy each) and keeps
+        # the copy only if the client did not write meanwhile; otherwise, or
+        # if the client is stuck mid-write, the last consistent copy is drawn.
+        seq, views = self.shared.read_views(timeout=SHARED_READ_TIMEOUT)
+        if seq is not None and (self._shared_copy is None or self._shared_copy[0] != seq):
+            length = min(int(views["length"][0]), views["x"].size)
+            x = views["x"][:length].copy()
+            y = views["y"][:length].copy()
+            if self.shared.is_current(seq):
+                self._shared_copy = seq, x, y
+        if self._shared_copy is None:
+            return None, None
+        return self._shared_copy[1:]
+
+    def _x_is_sorted(self, x):
+        if self._sorted_version != self.version:
+            self._is_sorted = len(x) < 2 or bool(np.all(x[1:] >= x[:-1]))
+            self._sorted_version = self.version
+        return self._is_sorted
+
+    def _slice_to_xlim(self, x, y, xlim):
+        # Keep one point beyond each edge so lines reach the border.
+        start = max(int(np.searchsorted(x, xlim[0], "left")) - 1, 0)
+        end = int(np.searchsorted(x, xlim[1], "right")) + 1
+        return x[start:end], y[start:end]
+
+    def get_display_data(self, xlim, n_pixels):
+        """Returns the data to draw on axes n_pixels wide showing xlim (None
+        for the full range), decimated to about two points per pixel.
+
+        The decimation is cached per data version and covers half a view
+        width beyond each side of xlim, so a view scrolling over unchanged
+        data is only sliced, not decimated again.
+        """
+        decimate = DECIMATORS.get(self.options.get("decimation", "minmax"))
+        if xlim is not None:
+            xlim = tuple(float(v) for v in xlim)
+        if decimate is not None and self._display_cache_key is not None:
+            version, cached_pixels, cached_range = self._display_cache_key
+            if version == self.version and cached_pixels == n_pixels:
+                if xlim is None and cached_range is None:
+                    return self._display_cache
+                if xlim is not None and cached_range is not None and self._covers(cached_range, xlim):
+                    return self._slice_to_xlim(*self._display_cache, xlim)
+
+        x, y = self.get_data()
+        if x is None or y is None or decimate is None or len(x) <= 2 * n_pixels:
+            return x, y
+        if len(x) != len(y) or not self._x_is_sorted(x):
+            return x, y
+
+        decimated_range = None
+        n_bins = n_pixels
+        if xlim is not None:
+            span = xlim[1] - xlim[0]
+            decimated_range = (xlim[0] - 0.5 * span, xlim[1] + 0.5 * span)
+            x, y = self._slice_to_xlim(x, y, decimated_range)
+            n_bins = 2 * n_pixels
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        if decimate is minmax_decimate:
+            result = minmax_decimate(x, y, n_bins)
+        else:
+            result = decimate(x, y, 2 * n_bins)
+
+        self._display_cache_key = (self.version, n_pixels, decimated_range)
+        self._display_cache = result
+        if xlim is not None:
+            return self._slice_to_xlim(*result, xlim)
+        return result
+
+    @staticmethod
+    def _covers(decimated_range, xlim):
+        # The cached points are only dense enough for views of about the
+        # width they were decimated for.
+        span = xlim[1] - xlim[0]
+        cached_span = 0.5 * (decimated_range[1] - decimated_range[0])
+        return (decimated_range[0] <= xlim[0] and xlim[1] <= decimated_range[1] and
+                0.9 * cached_span <= span <= 1.1 * cached_span)
+
 
 class PlotEntry:
     def __init__(self, options=None):
         self.options = options or {}
         self.lines = {}
+        self.ax = None
+        # Set when any line or option changed since the last render.
+        self.dirty = True
+        self.config_stale = True
+        self.legend_stale = True
+        self.last_render_time = -math.inf
         self.create_line("default", {})
 
+    def _line_defaults(self):
+        # History and decimation settings given at plot level apply to all
+        # of its lines.
+        return {key: self.options[key] for key in INHERITED_LINE_OPTIONS if key in self.options}
+
     def create_line(self, line_id, options):
         if line_id not in self.lines:
-            self.lines[line_id] = LineEntry(options)
+            self.lines[line_id] = LineEntry({**self._line_defaults(), **options})
+            self.legend_stale = True
         else:
-            self.lines[line_id].update_config(options)
+            self.config_line(line_id, options)
+        self.dirty = True
 
     def update_line(self, line_id, data, mode="append"):
         if line_id not in self.lines:
-            self.lines[line_id] = LineEntry()
+            self.lines[line_id] = LineEntry(self._line_defaults())
+            self.legend_stale = True
         self.lines[line_id].update_data(data, mode)
+        self.dirty = True
+
+    def update_line_shared(self, line_id, slot):
+        if line_id not in self.lines:
+            self.lines[line_id] = LineEntry(self._line_defaults())
+            self.legend_stale = True
+        self.lines[line_id].update_shared(slot)
+        self.dirty = True
 
     def config_line(self, line_id, options):
         if line_id in self.lines:
-            self.lines[line_id].update_config(options)
+            line = self.lines[line_id]
+            line.update_config(options)
+            # Style changes recreate the artist on the next render.
+            self._remove_artist(line)
+            self.legend_stale = True
+            self.dirty = True
 
     def remove_line(self, line_id):
         if line_id in self.lines:
+            self._remove_artist(self.lines[line_id])
             del self.lines[line_id]
+            self.legend_stale = True
+            self.dirty = True
 
     def update_config(self, options):
+        changed = [key for key, value in options.items()
+                   if key not in self.options or not _option_equal(self.options[key], value)]
+        if not changed:
+            return
         self.options.update(options)
+        if any(key not in ("xlim", "ylim", "max_fps") for key in changed):
+            self.config_stale = True
+        if "xlim" in changed:
+            # Lines are sliced and decimated to the visible range.
+            for line in self.lines.values():
+                line.dirty = True
+        self.dirty = True
+
+    def _remove_artist(self, line):
+        if line.artist is not None:
+            line.artist.remove()
+            line.artist = None
+
+    def attach(self, ax):
+        self.ax = ax
+        for line in self.lines.values():
+            line.artist = None
+            line.dirty = True
+        self.dirty = True
+        self.config_stale = True
+        self.legend_stale = True
+
+    def is_due(self, now):
+        max_fps = self.options.get("max_fps")
+        return not max_fps or now - self.last_render_time >= 1.0 / max_fps
 
-    def draw(self, ax):
+    def artists(self):
+        return [line.artist for line in self.lines.values() if line.artist is not None]
+
+    def render(self, animated=False, now=None):
+        """Updates the artists of the changed lines of this plot in place.
+
+        Returns True if anything outside the line artists changed (labels,
+        limits, legend), in which case the axes must be redrawn.
+        """
+        ax = self.ax
+        opts = self.options
+        full_draw = False
+
+        if self.config_stale:
+            ax.set_title(opts.get("title", ax.get_title()))
+            ax.set_xlabel(opts.get("xlabel", "X"))
+            ax.set_ylabel(opts.get("ylabel", "Y"))
+            ax.grid(visible=True, alpha=0.25)
+            self.config_stale = False
+            full_draw = True
+
+        xlim = opts.get("xlim")
+        n_pixels = max(int(ax.bbox.width), 1)
         for line_id, line in sorted(self.lines.items()):
-            x, y = line.get_data()
-            if x is not None and y is not None:
-                opts = line.options
-                plot_style = opts.get("plot_style", "-o")
-                markersize = opts.get("markersize", 4)
-                label = opts.get("label", line_id)
-                color = opts.get("color", None)
-                ax.plot(x, y, plot_style, markersize=markersize,
-                        label=label, color=color)
-        if self.lines:
-            ax.legend()
+            if not line.dirty:
+                continue
+            line.dirty = False
+            x, y = line.get_display_data(xlim, n_pixels)
+            if line.artist is None:
+                if x is None or y is None:
+                    continue
+                line_opts = line.options
+                line.artist, = ax.plot(
+                    x, y, line_opts.get("plot_style", "-o"),
+                    markersize=line_opts.get("markersize", 4),
+                    label=line_opts.get("label", line_id),
+                    color=line_opts.get("color", None),
+                    animated=animated)
+                self.legend_stale = True
+            elif x is None or y is None:
+                line.artist.set_data([], [])
+            else:
+                line.artist.set_data(x, y)
+
+        limits = ax.get_xlim(), ax.get_ylim()
+        if "xlim" not in opts or "ylim" not in opts:
+            ax.relim()
+            ax.autoscale_view(scalex="xlim" not in opts,
+                              scaley="ylim" not in opts)
+        if "xlim" in opts:
+            ax.set_xlim(opts["xlim"])
+        if "ylim" in opts:
+            ax.set_ylim(opts["ylim"])
+        if (ax.get_xlim(), ax.get_ylim()) != limits:
+            full_draw = True
+
+        if self.legend_stale:
+            if self.artists():
+                ax.legend()
+            self.legend_stale = False
+            full_draw = True
+
+        self.dirty = False
+        self.last_render_time = time.monotonic() if now is None else now
+        return full_draw
 
 
 class ClientWindow:
-    def __init__(self, client_id):
+    def __init__(self, client_id, blit=True, figure=None):
         self.client_id = client_id
         # Mapping: plot_id -> PlotEntry
         self.plots = {}
         self.lock = threading.Lock()
-        self.fig = plt.figure()
+        self.fig = plt.figure() if figure is None else figure
         self.fig.suptitle(f"Client {client_id} Plots")
+        self.blit = blit and self.fig.canvas.supports_blit
+        self.layout_stale = True
+        # Mapping: shared memory name -> SharedSlot attached for this client
+        self.shared_slots = {}
+        # Mapping: plot_id -> axes background without the animated lines
+        self.backgrounds = {}
+        if self.blit:
+            self.fig.canvas.mpl_connect("draw_event", self._on_draw)
+        # Mapping: plot_id -> figure-fraction bbox that holds the axes and
+        # its decorations (ticks, labels, title), updated on full draws
+        self.decoration_boxes = {}
 
     def create_plot(self, plot_id, options):
         with self.lock:
             if plot_id not in self.plots:
                 self.plots[plot_id] = PlotEntry(options)
+                self.layout_stale = True
             else:
                 self.plots[plot_id].update_config(options)
 
+    def _get_or_create_plot(self, plot_id):
+        if plot_id not in self.plots:
+            self.plots[plot_id] = PlotEntry()
+            self.layout_stale = True
+        return self.plots[plot_id]
+
     def update_plot(self, plot_id, data, mode="append"):
         with self.lock:
-            if plot_id not in self.plots:
-                self.plots[plot_id] = PlotEntry()
-            self.plots[plot_id].update_line("default", data, mode)
+            self._get_or_create_plot(plot_id).update_line(
+                "default", data, mode)
 
     def config_plot(self, plot_id, options):
         with self.lock:
@@ -159,18 +645,24 @@ class ClientWindow:
         with self.lock:
             if plot_id in self.plots:
                 del self.plots[plot_id]
+                self.layout_stale = True
 
     def create_line(self, plot_id, line_id, options):
         with self.lock:
-            if plot_id not in self.plots:
-                self.plots[plot_id] = PlotEntry()
-            self.plots[plot_id].create_line(line_id, options)
+            self._get_or_create_plot(plot_id).create_line(line_id, options)
 
     def update_line(self, plot_id, line_id, data, mode="append"):
         with self.lock:
-            if plot_id not in self.plots:
-                self.plots[plot_id] = PlotEntry()
-            self.plots[plot_id].update_line(line_id, data, mode)
+            self._get_or_create_plot(plot_id).update_line(
+                line_id, data, mode)
+
+    def update_line_shared(self, plot_id, line_id, spec):
+        with self.lock:
+            slot = self.shared_slots.get(spec["name"])
+            if slot is None:
+                slot = SharedSlot.attach(spec)
+                self.shared_slots[spec["name"]] = slot
+            self._get_or_create_plot(plot_id).update_line_shared(line_id, slot)
 
     def config_line(self, plot_id, line_id, options):
         with self.lock:
@@ -182,43 +674,411 @@ class ClientWindow:
             if plot_id in self.plots:
                 self.plots[plot_id].remove_line(line_id)
 
+    def _rebuild_layout(self):
+        self.fig.clf()
+        self.fig.suptitle(f"Client {self.client_id} Plots")
+        self.backgrounds = {}
+        self.decoration_boxes = {}
+        num_plots = len(self.plots)
+        # Calculate grid dimensions
+        cols = int(math.ceil(math.sqrt(num_plots)))
+        rows = int(math.ceil(num_plots / cols))
+        axes = self.fig.subplots(rows, cols)
+        if not isinstance(axes, np.ndarray):
+            axes = np.array([axes])
+        axes = axes.flatten()
+        sorted_plots = sorted(self.plots.items())
+        for i, ax in enumerate(axes):
+            if i < num_plots:
+                plot_id, plot_entry = sorted_plots[i]
+                ax.set_title(f"Plot {plot_id}")
+                plot_entry.attach(ax)
+                plot_entry.render(animated=self.blit)
+            else:
+                ax.set_visible(False)
+        self.fig.tight_layout()
+        self.layout_stale = False
+
+    def _on_draw(self, event):
+        canvas = self.fig.canvas
+        for plot_id, plot_entry in self.plots.items():
+            if plot_entry.ax is None:
+                continue
+            self.backgrounds[plot_id] = canvas.copy_from_bbox(
+                plot_entry.ax.bbox)
+            for artist in plot_entry.artists():
+                plot_entry.ax.draw_artist(artist)
+        self._update_decoration_boxes(event.renderer)
+
+    def _redraw_axes(self, plot_id, plot_entry):
+        """Redraws one axes with its decorations, e.g. after its limits
+        moved, and blits it without redrawing the rest of the figure."""
+        canvas = self.fig.canvas
+        renderer = canvas.get_renderer()
+        ax = plot_entry.ax
+        # Whole pixels, so neighbouring boxes meet without overlap
+        box = Bbox(np.round(self.fig.transFigure.transform(self.decoration_boxes[plot_id].get_points())))
+        # Erase the old ticks and labels, which may reach further than the
+        # new ones.
+        eraser = Rectangle(box.p0, box.width, box.height, transform=IdentityTransform(),
+                           facecolor=self.fig.get_facecolor(), edgecolor="none", antialiased=False)
+        eraser.set_figure(self.fig)
+        self.fig.draw_artist(eraser)
+        # Axes.draw() skips the animated line artists.
+        ax.draw(renderer)
+        self.backgrounds[plot_id] = canvas.copy_from_bbox(ax.bbox)
+        for artist in plot_entry.artists():
+            ax.draw_artist(artist)
+        canvas.blit(box)
+
+    @staticmethod
+    def _get_decoration_extent(ax, renderer):
+        # Cheaper than ax.get_tightbbox(): the texts are laid out already.
+        texts = [ax.title, ax.xaxis.label, ax.yaxis.label,
+                 *ax.xaxis.get_ticklabels(), *ax.yaxis.get_ticklabels()]
+        boxes = [text.get_window_extent(renderer) for text in texts
+                 if text.get_visible() and text.get_text()]
+        return Bbox.union([ax.bbox] + boxes)
+
+    def _update_decoration_boxes(self, renderer):
+        # Splits the figure between the axes in the middle of the free space
+        # between neighbours, so each axes' ticks and labels stay inside its
+        # own box. Boxes end below the figure title, which is not redrawn.
+        to_figure = self.fig.transFigure.inverted()
+        top = 1.0
+        if self.fig._suptitle is not None:
+            top = self.fig._suptitle.get_window_extent(renderer).transformed(to_figure).y0
+        # Mapping: plot_id -> (axes position, decoration extent) in figure fraction
+        boxes = {plot_id: (plot_entry.ax.get_position(),
+                           self._get_decoration_extent(plot_entry.ax, renderer).transformed(to_figure))
+                 for plot_id, plot_entry in self.plots.items() if plot_entry.ax is not None}
+        self.decoration_boxes = {}
+        for plot_id, (position, extent) in boxes.items():
+            x0, y0, x1, y1 = 0.0, 0.0, 1.0, top
+            for other_id, (other_position, other_extent) in boxes.items():
+                if other_id == plot_id:
+                    continue
+                if other_position.y0 < position.y1 and position.y0 < other_position.y1:
+                    if other_position.x1 <= position.x0:
+                        x0 = max(x0, 0.5 * (other_extent.x1 + extent.x0))
+                    elif other_position.x0 >= position.x1:
+                        x1 = min(x1, 0.5 * (extent.x1 + other_extent.x0))
+                if other_position.x0 < position.x1 and position.x0 < other_position.x1:
+                    if other_position.y1 <= position.y0:
+                        y0 = max(y0, 0.5 * (other_extent.y1 + extent.y0))
+                    elif other_position.y0 >= position.y1:
+                        y1 = min(y1, 0.5 * (extent.y1 + other_extent.y0))
+            self.decoration_boxes[plot_id] = Bbox.from_extents(x0, y0, x1, y1)
+
     def refresh(self):
+        """Re-renders the plots that changed and are due according to their
+        max_fps option. Returns True if some changed plots were held back
+        and refresh() should be called again later."""
         with self.lock:
-            num_plots = len(self.plots)
-            if num_plots == 0:
+            if len(self.plots) == 0:
                 print("No plots available.")
-                return
-            self.fig.clf()
-            # Calculate grid dimensions
-            cols = int(math.ceil(math.sqrt(num_plots)))
-            rows = int(math.ceil(num_plots / cols))
-            axes = self.fig.subplots(rows, cols)
-            if not isinstance(axes, np.ndarray):
-                axes = np.array([axes])
-            axes = axes.flatten()
-            sorted_plots = sorted(self.plots.items())
-            for i, ax in enumerate(axes):
-                if i < num_plots:
-                    ax.clear()
-                    plot_id, plot_entry = sorted_plots[i]
-                    opts = plot_entry.options
-                    ax.set_title(opts.get("title", f"Plot {plot_id}"))
-                    ax.set_xlabel(opts.get("xlabel", "X"))
-                    ax.set_ylabel(opts.get("ylabel", "Y"))
-                    ax.grid(visible=True, alpha=0.25)
-                    if "xlim" in opts:
-                        ax.set_xlim(opts["xlim"])
-                    if "ylim" in opts:
-                        ax.set_ylim(opts["ylim"])
-                    plot_entry.draw(ax)
-                else:
-                    ax.set_visible(False)
-            self.fig.tight_layout()
+                return False
+            full_draw = self.layout_stale
+            if self.layout_stale:
+                self._rebuild_layout()
+            now = time.monotonic()
+            # (plot_id, plot_entry, whether its axes must be redrawn)
+            changed = []
+            deferred = False
+            for plot_id, plot_entry in sorted(self.plots.items()):
+                if not plot_entry.dirty:
+                    continue
+                if not plot_entry.is_due(now):
+                    deferred = True
+                    continue
+                redraw_axes = plot_entry.render(animated=self.blit, now=now)
+                changed.append((plot_id, plot_entry, redraw_axes))
+
+            canvas = self.fig.canvas
+            if not self.blit:
+                if full_draw or changed:
+                    canvas.draw_idle()
+            elif full_draw or any(plot_id not in self.backgrounds for plot_id, _, _ in changed):
+                # Redraws everything; _on_draw captures the new backgrounds.
+                canvas.draw()
+            else:
+                # Blit only the axes that changed. Axes whose limits or
+                # labels changed, e.g. a sliding xlim, are redrawn alone.
+                for plot_id, plot_entry, redraw_axes in changed:
+                    if redraw_axes:
+                        self._redraw_axes(plot_id, plot_entry)
+                        continue
+                    canvas.restore_region(self.backgrounds[plot_id])
+                    for artist in plot_entry.artists():
+                        plot_entry.ax.draw_artist(artist)
+                    canvas.blit(plot_entry.ax.bbox)
+        self.fig.canvas.flush_events()
+        return deferred
+
+    def close(self):
+        plt.close(self.fig)
+        for slot in self.shared_slots.values():
+            slot.close()
+        self.shared_slots = {}
+
+
+def _append_point(msg):
+    """Returns the (x, y) of a single-point append message, with x None for
+    a bare value, or None if the message cannot be merged with others."""
+    if msg.get("mode", "append") != "append" or "shared" in msg:
+        return None
+    data = msg.get("data")
+    if isinstance(data, tuple) and len(data) == 2 and _is_scalar(data[0]) and _is_scalar(data[1]):
+        return data
+    if _is_scalar(data):
+        return None, data
+    return None
+
+
+def _merge_update(pending, msg):
+    # pending is the list of update messages queued for one line this frame.
+    if msg.get("mode", "append") == "replace" or "shared" in msg:
+        pending[:] = [msg]
+        return
+    point = _append_point(msg)
+    last = pending[-1] if pending else None
+    if point is not None and last is not None and last.get("mode") == "extend" and \
+            (last["data"][0] is None) == (point[0] is None):
+        if point[0] is not None:
+            last["data"][0].append(point[0])
+        last["data"][1].append(point[1])
+    elif point is not None:
+        xs = None if point[0] is None else [point[0]]
+        pending.append(dict(msg, mode="extend", data=(xs, [point[1]])))
+    else:
+        pending.append(msg)
+
+
+def coalesce_commands(items):
+    """Merges the commands received during one frame.
+
+    Config options are merged with the last write winning, single-point
+    appends to a line are concatenated into one "extend" update, and a
+    replace drops the earlier updates of its line. Structural commands
+    (create/remove, client registration) keep their order relative to
+    everything else from the same client.
+    """
+    result = []
+    # Mapping: client_id -> {(action, plot_id, line_id): merged message(s)}
+    pending = {}
+
+    def flush(client_id):
+        for key, merged in pending.pop(client_id, {}).items():
+            if key[0] in ("config", "config_line"):
+                result.append((client_id, merged))
+                continue
+            for msg in merged:
+                if msg.get("mode") == "extend":
+                    xs, ys = msg["data"]
+                    msg["data"] = (None if xs is None else np.array(xs, dtype=float),
+                                   np.array(ys, dtype=float))
+                result.append((client_id, msg))
+
+    for item in items:
+        if isinstance(item[0], str):
+            flush(item[1])
+            result.append(item)
+            continue
+
+        client_id, msg = item
+        action = msg.get("action")
+        if action == "update":
+            msg = dict(msg, action="update_line", line_id="default")
+            action = "update_line"
+        key = (action, msg.get("plot_id"), msg.get("line_id"))
+        merged = pending.setdefault(client_id, {})
+
+        if action in ("config", "config_line"):
+            if key in merged:
+                options = {**merged[key].get("options", {}), **msg.get("options", {})}
+                merged[key] = dict(merged[key], options=options)
+            else:
+                merged[key] = msg
+        elif action == "update_line":
+            _merge_update(merged.setdefault(key, []), msg)
+        else:
+            flush(client_id)
+            result.append(item)
+
+    for client_id in list(pending):
+        flush(client_id)
+    return result
+
+
+def apply_command(windows, item, make_window=ClientWindow):
+    """Applies one command to the ClientWindows in windows, creating them
+    with make_window(client_id). Returns the id of the affected client."""
+    if isinstance(item, tuple) and item[0] == 'register_client':
+        _, client_id = item
+        if client_id not in windows:
+            windows[client_id] = make_window(client_id)
+        return client_id
+    elif isinstance(item, tuple) and item[0] == 'remove_client':
+        _, client_id = item
+        if client_id in windows:
+            print(f"Removing all plots for client {client_id}")
+            windows[client_id].close()
+            del windows[client_id]
+        return client_id
+
+    client_id, msg = item
+    action = msg.get("action")
+    plot_id = msg.get("plot_id")
+    if client_id not in windows:
+        windows[client_id] = make_window(client_id)
+    cw = windows[client_id]
+    if action == "create":
+        options = msg.get("options", {})
+        cw.create_plot(plot_id, options)
+    elif action == "update" and "shared" in msg:
+        cw.update_line_shared(plot_id, "default", msg["shared"])
+    elif action == "update":
+        data = msg.get("data")
+        mode = msg.get("mode", "append")
+        cw.update_plot(plot_id, data, mode)
+    elif action == "config":
+        options = msg.get("options", {})
+        cw.config_plot(plot_id, options)
+    elif action == "remove":
+        cw.remove_plot(plot_id)
+    elif action == "create_line":
+        line_id = msg.get("line_id", "default")
+        options = msg.get("options", {})
+        cw.create_line(plot_id, line_id, options)
+    elif action == "update_line" and "shared" in msg:
+        line_id = msg.get("line_id", "default")
+        cw.update_line_shared(plot_id, line_id, msg["shared"])
+    elif action == "update_line":
+        line_id = msg.get("line_id", "default")
+        data = msg.get("data")
+        mode = msg.get("mode", "append")
+        cw.update_line(plot_id, line_id, data, mode)
+    elif action == "config_line":
+        line_id = msg.get("line_id", "default")
+        options = msg.get("options", {})
+        cw.config_line(plot_id, line_id, options)
+    elif action == "remove_line":
+        line_id = msg.get("line_id", "default")
+        cw.remove_line(plot_id, line_id)
+    return client_id
+
+
+def _offscreen_window(client_id):
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    return ClientWindow(client_id, figure=figure)
+
+
+def _publish_frame(cw, frame_slots, frames, output_dir):
+    rgba = np.asarray(cw.fig.canvas.buffer_rgba())
+    client_id = cw.client_id
+    if output_dir is not None:
+        path = os.path.join(output_dir, f"client_{client_id}.png")
+        matplotlib.image.imsave(path + ".tmp.png", rgba)
+        os.replace(path + ".tmp.png", path)
+        return
+
+    slot = frame_slots.get(client_id)
+    if slot is None or slot.views["rgba"].shape != rgba.shape:
+        if slot is not None:
+            slot.close()
+        slot = SharedSlot({"rgba": (rgba.shape, np.uint8)})
+        frame_slots[client_id] = slot
+    slot.write(rgba=rgba)
+    frames.put((client_id, slot.spec()))
+
+
+def _render_worker(commands, frames, output_dir):
+    """Worker process rendering its share of the client windows off-screen
+    with Agg. Receives lists of coalesced commands and publishes each
+    rendered frame through a per-client SharedSlot, or as a PNG file in
+    output_dir."""
+    windows = {}
+    # Mapping: client_id -> SharedSlot holding the last rendered frame
+    frame_slots = {}
+    deferred = set()
+    running = True
+    try:
+        while running:
+            items = []
+            try:
+                batch = commands.get(timeout=0.01 if deferred else None)
+                while True:
+                    if batch is None:
+                        running = False
+                        break
+                    items.extend(batch)
+                    batch = commands.get_nowait()
+            except queue.Empty:
+                pass
+
+            touched = deferred
+            deferred = set()
+            for item in items:
+                client_id = apply_command(windows, item, _offscreen_window)
+                touched.add(client_id)
+                if client_id not in windows and client_id in frame_slots:
+                    frame_slots.pop(client_id).close()
+
+            for client_id in touched:
+                cw = windows.get(client_id)
+                if cw is None or not cw.plots:
+                    continue
+                if cw.refresh():
+                    deferred.add(client_id)
+                _publish_frame(cw, frame_slots, frames, output_dir)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for cw in windows.values():
+            cw.close()
+        for slot in frame_slots.values():
+            slot.close()
+
+
+class FrameWindow:
+    """Lightweight on-screen window showing frames rendered by a worker."""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.fig = plt.figure(f"Client {client_id} Plots")
+        self.ax = self.fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+        self.image = None
+        self.slot = None
+        self.rgba = None
+
+    def show(self, spec):
+        if self.slot is None or self.slot.name != spec["name"]:
+            if self.slot is not None:
+                self.slot.close()
+            self.slot = SharedSlot.attach(spec)
+            self.rgba = None
+        seq, values = self.slot.read(None if self.rgba is None else {"rgba": self.rgba},
+                                     timeout=SHARED_READ_TIMEOUT)
+        self.rgba = values["rgba"]
+        if seq is None:
+            # The worker is stuck mid-write; keep showing the last frame.
+            return
+        if self.image is None:
+            height, width = self.rgba.shape[:2]
+            self.fig.set_size_inches(width / self.fig.dpi, height / self.fig.dpi)
+            self.image = self.ax.imshow(self.rgba)
+        else:
+            self.image.set_data(self.rgba)
         self.fig.canvas.draw_idle()
         self.fig.canvas.flush_events()
 
     def close(self):
         plt.close(self.fig)
+        if self.slot is not None:
+            self.slot.close()
+            self.slot = None
 
 
 class ClientHandler(threading.Thread):
@@ -241,8 +1101,71 @@ class ClientHandler(threading.Thread):
             print(f"Client {self.client_id} disconnected.")
 
 
+class PlotServiceStats:
+    """Throughput and latency counters of a PlotService, see plot_benchmark.py."""
+
+    def __init__(self, max_samples=100000):
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.monotonic()
+        self.messages = 0
+        self.frames = 0
+        self.queue_depths = deque(maxlen=self.max_samples)
+        self.redraw_times = deque(maxlen=self.max_samples)
+        # Seconds from PlotClient send (timestamp_messages=True) to the end
+        # of the render showing the update.
+        self.latencies = deque(maxlen=self.max_samples)
+        # Mapping: client_id -> send times of applied, not yet rendered messages
+        self.unrendered = {}
+
+    def record_batch(self, batch, queue_depth):
+        self.queue_depths.append(queue_depth)
+        for item in batch:
+            if isinstance(item[0], str):
+                continue
+            client_id, msg = item
+            self.messages += 1
+            if "sent_at" in msg:
+                self.unrendered.setdefault(client_id, []).append(msg["sent_at"])
+
+    def record_render(self, client_id, redraw_time, deferred):
+        self.frames += 1
+        self.redraw_times.append(redraw_time)
+        if not deferred:
+            now = time.time()
+            self.latencies.extend(now - sent_at for sent_at in self.unrendered.pop(client_id, []))
+
+    def summary(self):
+        def percentiles(samples):
+            if not samples:
+                return {}
+            values = np.array(samples)
+            return {
+                "mean": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "p99": float(np.percentile(values, 99)),
+                "max": float(values.max()),
+            }
+
+        elapsed = time.monotonic() - self.start_time
+        return {
+            "elapsed": elapsed,
+            "messages": self.messages,
+            "messages_per_second": self.messages / elapsed if elapsed > 0 else 0.0,
+            "frames": self.frames,
+            "frames_per_second": self.frames / elapsed if elapsed > 0 else 0.0,
+            "queue_depth": percentiles(self.queue_depths),
+            "redraw_time": percentiles(self.redraw_times),
+            "latency": percentiles(self.latencies),
+        }
+
+
 class PlotService:
-    def __init__(self, address=None, authkey=b'secret password'):
+    def __init__(self, address=None, authkey=b'secret password', max_fps=30.0, idle_timeout=0.1,
+                 render_processes=0, output_dir=None, collect_stats=False):
         if address is None:
             address = r'\\.\pipe\plot_service' if os.name == 'nt' else '/tmp/plot_service.sock'
         self.address = address
@@ -252,6 +1175,28 @@ class PlotService:
         self.listener = Listener(address, authkey=authkey)
         self.client_id_counter = 0
         self.handlers = []
+        # Upper bound on renders per second; None renders every batch.
+        self.max_fps = max_fps
+        # How long to wait for commands before servicing GUI events.
+        self.idle_timeout = idle_timeout
+        self.stop_event = threading.Event()
+        # Clients with changed plots held back by their max_fps.
+        self.deferred_clients = set()
+        # With render_processes > 0 client windows are rendered off-screen in
+        # that many worker processes and shown here, or written to
+        # output_dir as client_<id>.png if given.
+        self.render_processes = render_processes
+        self.output_dir = output_dir
+        self.render_queues = []
+        self.render_workers = []
+        self.frames = None
+        self.frame_thread = None
+        # Mapping: client_id -> index of the worker rendering it
+        self.client_workers = {}
+        # Mapping: client_id -> FrameWindow
+        self.frame_windows = {}
+        # Redraw time and latency are only measured when rendering locally.
+        self.stats = PlotServiceStats() if collect_stats else None
 
     def start(self):
         print(f"Plot service started at {self.address}")
@@ -260,6 +1205,9 @@ class PlotService:
         accept_thread.start()
         self.run_plot_loop()
 
+    def stop(self):
+        self.stop_event.set()
+
     def accept_clients(self):
         while True:
             try:
@@ -273,67 +1221,163 @@ class PlotService:
             self.handlers.append(handler)
             print(f"Accepted client {self.client_id_counter}")
 
+    def _collect_commands(self, timeout):
+        items = []
+        try:
+            items.append(command_queue.get(timeout=timeout))
+        except queue.Empty:
+            return items
+        while True:
+            try:
+                items.append(command_queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def _start_render_workers(self):
+        self.frames = mp.Queue()
+        for _ in range(self.render_processes):
+            commands = mp.Queue()
+            worker = mp.Process(
+                target=_render_worker,
+                args=(commands, self.frames, self.output_dir), daemon=True)
+            worker.start()
+            self.render_queues.append(commands)
+            self.render_workers.append(worker)
+        if self.output_dir is None:
+            self.frame_thread = threading.Thread(
+                target=self._forward_frames, daemon=True)
+            self.frame_thread.start()
+
+    def _stop_render_workers(self):
+        for commands in self.render_queues:
+            commands.put(None)
+        for worker in self.render_workers:
+            worker.join()
+        if self.frame_thread is not None:
+            self.frames.put(None)
+            self.frame_thread.join()
+        for frame_window in self.frame_windows.values():
+            frame_window.close()
+        self.frame_windows = {}
+
+    def _forward_frames(self):
+        # Wakes the plot loop whenever a worker has published a frame.
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            command_queue.put(('frame',) + item)
+
+    def _least_loaded_worker(self):
+        loads = [0] * self.render_processes
+        for worker in self.client_workers.values():
+            loads[worker] += 1
+        return loads.index(min(loads))
+
+    def _dispatch_commands(self, items):
+        # Client windows stay on one worker so their artists persist.
+        batches = {}
+        for item in items:
+            client_id = item[1] if isinstance(item[0], str) else item[0]
+            if client_id not in self.client_workers:
+                self.client_workers[client_id] = self._least_loaded_worker()
+            worker = self.client_workers[client_id]
+            batches.setdefault(worker, []).append(item)
+            if item[0] == 'remove_client':
+                del self.client_workers[client_id]
+                if client_id in self.frame_windows:
+                    self.frame_windows.pop(client_id).close()
+        for worker, batch in batches.items():
+            self.render_queues[worker].put(batch)
+
+    def _show_frames(self, frames):
+        for client_id, spec in frames.items():
+            if client_id not in self.client_workers:
+                continue
+            if client_id not in self.frame_windows:
+                self.frame_windows[client_id] = FrameWindow(client_id)
+            self.frame_windows[client_id].show(spec)
+
+    def _render_locally(self, items):
+        changed_clients = self.deferred_clients
+        self.deferred_clients = set()
+        for item in items:
+            changed_clients.add(apply_command(client_windows, item))
+        for client_id, cw in list(client_windows.items()):
+            if client_id not in changed_clients:
+                continue
+            start = time.perf_counter()
+            deferred = cw.refresh()
+            if deferred:
+                self.deferred_clients.add(client_id)
+            if self.stats is not None:
+                self.stats.record_render(
+                    client_id, time.perf_counter() - start, deferred)
+
     def run_plot_loop(self):
+        frame_period = 1.0 / self.max_fps if self.max_fps else 0.0
+        next_frame = time.monotonic()
+        batch = []
+        if self.render_processes:
+            self._start_render_workers()
         try:
-            while True:
-                while not command_queue.empty():
-                    item = command_queue.get()
-                    if isinstance(item, tuple) and item[0] == 'register_client':
-                        _, client_id = item
-                        if client_id not in client_windows:
-                            client_windows[client_id] = ClientWindow(client_id)
-                    elif isinstance(item, tuple) and item[0] == 'remove_client':
-                        _, client_id = item
-                        if client_id in client_windows:
-                            print(f"Removing all plots for client {client_id}")
-                            client_windows[client_id].close()
-                            del client_windows[client_id]
+            while not self.stop_event.is_set():
+                # Sleep until the next frame is due once there is something
+                # to draw, otherwise until commands arrive.
+                if batch or self.deferred_clients:
+                    timeout = max(next_frame - time.monotonic(), 0.0)
+                else:
+                    timeout = self.idle_timeout
+
+                # Mapping: client_id -> latest frame published by a worker
+                frames = {}
+                for item in self._collect_commands(timeout):
+                    if item[0] == 'frame':
+                        frames[item[1]] = item[2]
                     else:
-                        client_id, msg = item
-                        action = msg.get("action")
-                        plot_id = msg.get("plot_id")
-                        if client_id not in client_windows:
-                            client_windows[client_id] = ClientWindow(client_id)
-                        cw = client_windows[client_id]
-                        if action == "create":
-                            options = msg.get("options", {})
-                            cw.create_plot(plot_id, options)
-                        elif action == "update":
-                            data = msg.get("data")
-                            mode = msg.get("mode", "append")
-                            cw.update_plot(plot_id, data, mode)
-                        elif action == "config":
-                            options = msg.get("options", {})
-                            cw.config_plot(plot_id, options)
-                        elif action == "remove":
-                            cw.remove_plot(plot_id)
-                        elif action == "create_line":
-                            line_id = msg.get("line_id", "default")
-                            options = msg.get("options", {})
-                            cw.create_line(plot_id, line_id, options)
-                        elif action == "update_line":
-                            line_id = msg.get("line_id", "default")
-                            data = msg.get("data")
-                            mode = msg.get("mode", "append")
-                            cw.update_line(plot_id, line_id, data, mode)
-                        elif action == "config_line":
-                            line_id = msg.get("line_id", "default")
-                            options = msg.get("options", {})
-                            cw.config_line(plot_id, line_id, options)
-                        elif action == "remove_line":
-                            line_id = msg.get("line_id", "default")
-                            cw.remove_line(plot_id, line_id)
-                for cw in list(client_windows.values()):
-                    cw.refresh()
+                        batch.append(item)
+                if frames:
+                    self._show_frames(frames)
+
+                now = time.monotonic()
+                if (batch or self.deferred_clients) and now >= next_frame:
+                    if self.stats is not None:
+                        self.stats.record_batch(
+                            batch, len(batch) + command_queue.qsize())
+                    items = coalesce_commands(batch)
+                    batch = []
+                    if self.render_processes:
+                        self._dispatch_commands(items)
+                    else:
+                        self._render_locally(items)
+                    next_frame = now + frame_period
+                elif not batch and not frames:
+                    # Keep idle windows responsive.
+                    windows = list(client_windows.values()) + list(self.frame_windows.values())
+                    for window in windows:
+                        window.fig.canvas.flush_events()
         except KeyboardInterrupt:
             print("Plot service shutting down.")
         finally:
             self.listener.close()
+            self._stop_render_workers()
             plt.ioff()
             plt.show()
 
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Plot service")
+    parser.add_argument("--max-fps", type=float, default=30.0)
+    parser.add_argument("--render-processes", type=int, default=0,
+                        help="render client windows off-screen in this many worker processes")
+    parser.add_argument("--output-dir", default=None,
+                        help="write rendered frames here instead of showing them (headless)")
+    args = parser.parse_args()
+
     plt.ion()
-    service = PlotService()
+    service = PlotService(max_fps=args.max_fps,
+                          render_processes=args.render_processes,
+                          output_dir=args.output_dir)
     service.start()
@@ -0,0 +1,251 @@
+from typing import List, Optional, Tuple, Union
+from stoppable_thread import StoppableThread
+from rgbd_stream import FrameBuffers, RGBDFrame, RGBDStream
+from numpy.typing import NDArray
+import numpy as np
+import threading
+import time
+
+
+def _is_in_buffers(frame: RGBDFrame, buffers: Optional[FrameBuffers]) -> bool:
+    return (buffers is not None and 'rgb_u8' in vars(frame)
+            and frame.rgb_u8 is buffers[0] and frame.depth is buffers[1] and frame.confidence is buffers[2])
+
+
+class RGBDCapture:
+    '''Builds RGBDFrames from a stream on a background thread.
+
+    Frames go through a triple buffer: the capture thread writes into the
+    back slot and swaps it with the ready slot once the frame is complete,
+    and get_latest_frame() swaps the ready slot into the front slot. Neither
+    side ever waits for the other, and each slot's arrays are reused for
+    later frames.
+    '''
+
+    def __init__(self, stream: RGBDStream) -> None:
+        self.stream = stream
+
+        # Each slot: (frame, sequence number, capture timestamp)
+        self._slots = [(None, 0, 0.0) for _ in range(3)]
+        self._back, self._ready, self._front = 0, 1, 2
+        self._fresh = False
+        self._lock = threading.Lock()
+        self._new_frame = threading.Event()
+
+        self.seq = 0
+        self.thread = None
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        if not self.stream.is_running():
+            self.stream.start()
+        self.thread = StoppableThread(self._capture_loop, name='RGBDCapture')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is None:
+            return
+        self.thread.stop()
+        self.thread.join()
+        self.thread = None
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def _capture_loop(self, stop_event: threading.Event, args) -> None:
+        while not stop_event.is_set():
+            if not self.stream.wait_for_frames(timeout=0.1):
+                continue
+            timestamp = time.monotonic()
+
+            # The back slot is only ever touched by this thread.
+            previous = self._slots[self._back][0]
+            buffers = None
+            # Only reuse frames the stream built from uint8 RGB; anything
+            # else would convert the old frame just to throw it away.
+            if previous is not None and 'rgb_u8' in vars(previous):
+                buffers = (previous.rgb_u8, previous.depth, previous.confidence)
+            frame = self.stream.acquire_frame(buffers)
+
+            self.seq += 1
+            with self._lock:
+                self._slots[self._back] = (frame, self.seq, timestamp)
+                self._back, self._ready = self._ready, self._back
+                self._fresh = True
+            self._new_frame.set()
+
+    def get_latest_frame(self) -> Tuple[Optional[RGBDFrame], int, float]:
+        '''Returns the newest complete frame with its sequence number and
+        capture timestamp (time.monotonic()), or (None, 0, 0.0) before the
+        first frame. Never blocks on the camera.
+
+        The returned frame stays valid until a later call returns a frame
+        with a different sequence number.
+        '''
+        with self._lock:
+            if self._fresh:
+                self._front, self._ready = self._ready, self._front
+                self._fresh = False
+            return self._slots[self._front]
+
+    def wait_for_frame(self, timeout: Optional[float] = None) -> bool:
+        '''Blocks until a frame newer than the last one returned by
+        get_latest_frame() is available.'''
+        self._new_frame.clear()
+        with self._lock:
+            if self._fresh:
+                return True
+        return self._new_frame.wait(timeout)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class MultiRGBDCapture:
+    '''Captures several streams in parallel and returns time-aligned frame
+    sets.
+
+    Each stream gets its own capture thread, which also applies that
+    camera's calibration, and keeps its last history frames. A frame set
+    pairs the newest frame of the stream that is furthest behind with the
+    closest frame in time from every other stream. Sources can be
+    RGBDStreams, Record3D device indices or paths of RGBDRecorder
+    recordings.
+    '''
+
+    def __init__(
+        self,
+        sources: List[Union[RGBDStream, int, str]],
+        calibration_matrices: Optional[List[NDArray]] = None,
+        history: int = 4,
+    ) -> None:
+        self.streams = [self._open(source) for source in sources]
+        if calibration_matrices is None:
+            calibration_matrices = [None] * len(self.streams)
+        self.calibration_matrices = calibration_matrices
+
+        # Per stream: ring of (frame, sequence number, capture timestamp)
+        self._slots = [[(None, 0, 0.0) for _ in range(history + 2)] for _ in self.streams]
+        # Per stream: slot last returned to the caller
+        self._held = [None] * len(self.streams)
+        self._lock = threading.Lock()
+        self._new_frame = threading.Event()
+
+        self.threads = []
+
+    @staticmethod
+    def _open(source: Union[RGBDStream, int, str]) -> RGBDStream:
+        if isinstance(source, RGBDStream):
+            return source
+        if isinstance(source, str):
+            from rgbd_recording import RGBDStream_Replay
+            return RGBDStream_Replay(source)
+        from rgbd_stream import RGBDStream_iOS
+        return RGBDStream_iOS(source)
+
+    def start(self) -> None:
+        if self.threads:
+            return
+        for stream_index, stream in enumerate(self.streams):
+            if not stream.is_running():
+                stream.start()
+            thread = StoppableThread(self._capture_loop, stream_index, name=f'RGBDCapture-{stream_index}')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self) -> None:
+        for thread in self.threads:
+            thread.stop()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _capture_loop(self, stop_event: threading.Event, stream_index: int) -> None:
+        stream = self.streams[stream_index]
+        slots = self._slots[stream_index]
+        calibration_matrix = self.calibration_matrices[stream_index]
+        inverse_calibration_rotation = None
+        if calibration_matrix is not None:
+            inverse_calibration_rotation = np.linalg.inv(calibration_matrix[0:3, 0:3])
+
+        # Per slot: the (uint8 RGB, depth, confidence) arrays it owns. The
+        # stream's own buffers (e.g. RGBDStream_iOS's pool) are reused by
+        # the stream after a few frames, fewer than the ring holds, so no
+        # slot may keep them.
+        slot_buffers = [None] * len(slots)
+        seq = 0
+        while not stop_event.is_set():
+            if not stream.wait_for_frames(timeout=0.1):
+                continue
+            timestamp = time.monotonic()
+
+            with self._lock:
+                # Overwrite the oldest frame the caller is not holding.
+                slot = min((i for i in range(len(slots)) if i != self._held[stream_index]),
+                           key=lambda i: slots[i][1])
+                slots[slot] = (None, 0, 0.0)
+
+            buffers = slot_buffers[slot]
+            frame = stream.acquire_frame(buffers)
+            if not _is_in_buffers(frame, buffers):
+                # First frame of this slot, a size change, or a stream that
+                # cannot write into given buffers: copy into the slot's own.
+                images = (frame.rgb_u8, frame.depth, frame.confidence)
+                if buffers is None or any(buffer.shape != image.shape or buffer.dtype != image.dtype
+                                          for buffer, image in zip(buffers, images)):
+                    buffers = tuple(np.empty_like(image) for image in images)
+                    slot_buffers[slot] = buffers
+                for buffer, image in zip(buffers, images):
+                    np.copyto(buffer, image)
+                frame = RGBDFrame(*buffers, frame.camera)
+            if calibration_matrix is not None:
+                frame.camera.calibrate(calibration_matrix, inverse_calibration_rotation)
+
+            seq += 1
+            with self._lock:
+                slots[slot] = (frame, seq, timestamp)
+            self._new_frame.set()
+
+    def get_frame_set(self, max_skew: Optional[float] = None) -> Optional[Tuple[List[RGBDFrame], List[int], List[float]]]:
+        '''Returns the best aligned (frames, sequence numbers, timestamps),
+        or None until every stream has a frame or while the timestamps
+        spread more than max_skew seconds. Never blocks on the cameras.
+
+        The frames stay valid until the next call.
+        '''
+        with self._lock:
+            ready = [[i for i, (frame, _, _) in enumerate(slots) if frame is not None]
+                     for slots in self._slots]
+            if not all(ready):
+                return None
+
+            reference_time = min(max(slots[i][2] for i in indices)
+                                 for slots, indices in zip(self._slots, ready))
+            chosen = [min(indices, key=lambda i: abs(slots[i][2] - reference_time))
+                      for slots, indices in zip(self._slots, ready)]
+
+            frame_set = [slots[i] for slots, i in zip(self._slots, chosen)]
+            timestamps = [timestamp for _, _, timestamp in frame_set]
+            if max_skew is not None and max(timestamps) - min(timestamps) > max_skew:
+                return None
+            self._held = chosen
+            return [frame for frame, _, _ in frame_set], [seq for _, seq, _ in frame_set], timestamps
+
+    def wait_for_frames(self, timeout: Optional[float] = None) -> bool:
+        '''Blocks until any stream has a new frame.'''
+        self._new_frame.clear()
+        return self._new_frame.wait(timeout)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,180 @@
+from typing import Dict, Optional, Tuple
+from rgbd_stream import RGBDFrame, get_pixel_grid
+from numpy.typing import DTypeLike, NDArray
+import numpy as np
+import time
+import cv2
+
+
+class GeometryKernels:
+    '''Point-cloud kernels that work in preallocated workspaces.
+
+    Results are views into workspaces owned by this object and are
+    overwritten by the next call of the same kernel; copy anything that
+    must live longer. Workspaces only grow, so after the first frames the
+    memory footprint stays fixed.
+
+    Kernels run at a pyramid level: level L samples every 2**L-th depth
+    pixel in each direction, so levels 1 and 2 cost about 1/4 and 1/16 of
+    full resolution. upsample() maps per-pixel results back. With
+    time_budget, process() moves to a coarser level whenever a frame took
+    longer than the budget and back to a finer one when there is ample
+    room, within max_level.
+    '''
+
+    def __init__(self, level: int = 0, max_level: int = 2, time_budget: Optional[float] = None) -> None:
+        self.level = level
+        self.max_level = max_level
+        self.time_budget = time_budget
+        self.last_time = 0.0
+
+        self._workspaces: Dict[str, NDArray] = {}
+        # Mapping: workspace name -> (shape, level, offset) of the pixel grid
+        # it holds
+        self._grid_keys: Dict[str, Tuple] = {}
+
+    def _workspace(self, name: str, shape: Tuple[int, ...], dtype: DTypeLike = np.float64) -> NDArray:
+        '''Returns a workspace array of the given shape, reusing the
+        previous one of that name if it is large enough.'''
+        workspace = self._workspaces.get(name)
+        size = int(np.prod(shape))
+        if workspace is None or workspace.size < size or workspace.dtype != np.dtype(dtype):
+            capacity = 1 << max(size - 1, 0).bit_length()
+            workspace = np.empty(capacity, dtype=dtype)
+            self._workspaces[name] = workspace
+            self._grid_keys.pop(name, None)
+        return workspace[:size].reshape(shape)
+
+    def _contiguous(self, name: str, image: NDArray) -> NDArray:
+        if image.flags.c_contiguous:
+            return image
+        workspace = self._workspace(name, image.shape, image.dtype)
+        np.copyto(workspace, image)
+        return workspace
+
+    def get_level_images(self, frame: RGBDFrame, level: Optional[int] = None) -> Tuple[NDArray, NDArray]:
+        '''Returns the depth and confidence images at the pyramid level, as
+        strided views.'''
+        step = 1 << (self.level if level is None else level)
+        return frame.depth[::step, ::step], frame.confidence[::step, ::step]
+
+    def compute_XYZ(self, frame: RGBDFrame, level: Optional[int] = None) -> NDArray:
+        '''Returns world points of the depth pixels sampled at the level.'''
+        level = self.level if level is None else level
+        step = 1 << level
+        depth, _ = self.get_level_images(frame, level)
+        height, width = depth.shape
+
+        xyz = self._workspace('xyz', (height, width, 3))
+        # The pixel grid only changes with the image size, level or ROI.
+        grid_key = (depth.shape, level, frame.offset)
+        if self._grid_keys.get('xyz') != grid_key:
+            grid = get_pixel_grid(height, width)
+            xyz[..., 0] = grid[..., 0] * step + (frame.offset[1] - 0.5 * (step - 1))
+            xyz[..., 1] = grid[..., 1] * step + (frame.offset[0] - 0.5 * (step - 1))
+            self._grid_keys['xyz'] = grid_key
+        xyz[..., 2] = depth
+
+        XYZ = self._workspace('XYZ', (height, width, 3))
+        return frame.camera.screen_to_world(xyz, frame.full_shape[1], frame.full_shape[0], out=XYZ)
+
+    def compute_normals(self, XYZ: NDArray) -> NDArray:
+        '''Same as RGBDFrame.get_normals(), from differences with the pixel
+        above and the pixel to the left (wrapping at the borders), without
+        temporaries.'''
+        shape = XYZ.shape
+        down = self._workspace('down', shape)
+        right = self._workspace('right', shape)
+        normals = self._workspace('normals', shape)
+        product = self._workspace('product', shape[:-1])
+        square = self._workspace('square', shape[:-1])
+
+        np.subtract(XYZ[:-1], XYZ[1:], out=down[1:])
+        np.subtract(XYZ[-1], XYZ[0], out=down[0])
+        np.subtract(XYZ[:, :-1], XYZ[:, 1:], out=right[:, 1:])
+        np.subtract(XYZ[:, -1], XYZ[:, 0], out=right[:, 0])
+
+        # normals = cross(down, right), one component at a time
+        for i, j, k in ((0, 1, 2), (1, 2, 0), (2, 0, 1)):
+            np.multiply(down[..., j], right[..., k], out=normals[..., i])
+            np.multiply(down[..., k], right[..., j], out=product)
+            normals[..., i] -= product
+
+        np.multiply(normals[..., 0], normals[..., 0], out=product)
+        for i in (1, 2):
+            np.multiply(normals[..., i], normals[..., i], out=square)
+            product += square
+        np.sqrt(product, out=product)
+        normals /= product[..., None]
+        return normals
+
+    def get_carved_points_mask(self, frame: RGBDFrame, XYZ: NDArray, level: Optional[int] = None) -> NDArray:
+        '''Same as RGBDFrame.get_carved_points_mask(), tested against the
+        depth image at the pyramid level.'''
+        step = 1 << (self.level if level is None else level)
+        depth, confidence = self.get_level_images(frame, level)
+        height, width = depth.shape
+        n = len(XYZ)
+
+        xyz = self._workspace('carve_xyz', (n, 3))
+        frame.camera.world_to_screen(XYZ, frame.full_shape[1], frame.full_shape[0], out=xyz)
+        # To level pixel coordinates
+        xyz[:, 0] -= frame.offset[1]
+        xyz[:, 1] -= frame.offset[0]
+        xyz[:, :2] /= step
+
+        is_valid = self._workspace('carve_mask', (n,), bool)
+        scratch = self._workspace('carve_scratch', (n,), bool)
+        np.less(xyz[:, 0], 0.0, out=is_valid)
+        is_valid |= np.greater_equal(xyz[:, 0], width, out=scratch)
+        is_valid |= np.less(xyz[:, 1], 0.0, out=scratch)
+        is_valid |= np.greater_equal(xyz[:, 1], height, out=scratch)
+        is_valid |= np.less(xyz[:, 2], 0.0, out=scratch)
+
+        # Flat pixel indices, for gathering from the images in one pass
+        index = self._workspace('carve_index', (n,), np.intp)
+        column = self._workspace('carve_column', (n,), np.intp)
+        np.clip(xyz[:, 0], 0, width - 1, out=xyz[:, 0])
+        np.clip(xyz[:, 1], 0, height - 1, out=xyz[:, 1])
+        np.copyto(index, xyz[:, 1], casting='unsafe')
+        np.copyto(column, xyz[:, 0], casting='unsafe')
+        index *= width
+        index += column
+
+        confidence = self._contiguous('carve_confidence', confidence)
+        depth = self._contiguous('carve_depth', depth)
+        gathered_confidence = self._workspace('carve_gathered_confidence', (n,), confidence.dtype)
+        gathered_depth = self._workspace('carve_gathered_depth', (n,), depth.dtype)
+        np.take(confidence.reshape(-1), index, out=gathered_confidence)
+        np.take(depth.reshape(-1), index, out=gathered_depth)
+
+        margin = self._workspace('carve_margin', (n,))
+        np.multiply(gathered_confidence, -0.5, out=margin)
+        margin += 2.5
+        margin *= xyz[:, 2]
+        is_valid |= np.greater_equal(margin, gathered_depth, out=scratch)
+        return is_valid
+
+    def upsample(self, values: NDArray, shape: Tuple[int, int]) -> NDArray:
+        '''Nearest-neighbor upsampling of per-pixel level values to shape,
+        e.g. frame.depth.shape.'''
+        if values.ndim == 3 and values.shape[2] > 4:
+            raise ValueError('upsample() supports at most 4 channels')
+        out = self._workspace('upsampled', shape + values.shape[2:], values.dtype)
+        return cv2.resize(values, shape[::-1], dst=out, interpolation=cv2.INTER_NEAREST)
+
+    def process(self, frame: RGBDFrame) -> Tuple[NDArray, NDArray]:
+        '''Computes world points and normals at the current level, then
+        adapts the level to time_budget.'''
+        start = time.perf_counter()
+        XYZ = self.compute_XYZ(frame)
+        normals = self.compute_normals(XYZ)
+        self.last_time = time.perf_counter() - start
+
+        if self.time_budget is not None:
+            if self.last_time > self.time_budget and self.level < self.max_level:
+                self.level += 1
+            elif self.last_time * 4.0 < 0.5 * self.time_budget and self.level > 0:
+                # A finer level costs about 4x; only go there with headroom.
+                self.level -= 1
+        return XYZ, normals
@@ -0,0 +1,391 @@
+'''Recording and replay of RGBD streams.
+
+RGBDSessionRecorder writes compressed recordings for keeping: MJPG video,
+16-bit PNG depth and a CSV index, encoded on background threads.
+
+An RGBDRecorder recording is a single file: a header, one chunk per frame holding the
+uint8 RGB, float32 depth and uint8 confidence images, and an index at the
+end with each frame's offset, image shapes, capture time and camera. The
+images of every frame are 64-byte aligned, so RGBDStream_Replay can hand out
+zero-copy views of a memory map of the file. Record from the iPhone with:
+
+    python rgbd_recording.py recording.rgbd --duration 30
+'''
+from typing import List, Optional
+from rgbd_stream import RGBDFrame, RGBDStream, RGBDStream_iOS, FrameBuffers
+from camera import Camera, Intrinsics
+from numpy.typing import NDArray
+import numpy as np
+import argparse
+import struct
+import threading
+import queue
+import time
+import csv
+import os
+import cv2
+
+MAGIC = b'RGBDREC1'
+_ALIGNMENT = 64
+# Index offset, frame count, magic
+_FOOTER = struct.Struct('<QQ8s')
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('timestamp', '<f8'),
+    ('rgb_shape', '<u4', (3,)),
+    ('depth_shape', '<u4', (2,)),
+    ('confidence_shape', '<u4', (2,)),
+    # Normalized fx, fy, px, py
+    ('intrinsics', '<f8', (4,)),
+    ('orthographic', '?'),
+    ('position', '<f8', (3,)),
+    ('rotation_matrix', '<f8', (3, 3)),
+])
+
+_IMAGE_DTYPES = (np.dtype(np.uint8), np.dtype('<f4'), np.dtype(np.uint8))
+
+
+def _aligned(nbytes: int) -> int:
+    return -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+
+
+class RGBDRecorder:
+    '''Appends RGBDFrames to a recording file; see the module docstring.
+
+    Frames must be written before their cameras are calibrated, since
+    replay returns the cameras exactly as recorded. The index is written by
+    close(), so a recording that was never closed cannot be replayed.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, 'wb')
+        self._write_padded(MAGIC)
+        self.index = []
+
+    def _write_padded(self, data) -> None:
+        nbytes = memoryview(data).nbytes
+        self.file.write(data)
+        self.file.write(bytes(_aligned(nbytes) - nbytes))
+
+    def write(self, frame: RGBDFrame, timestamp: Optional[float] = None) -> None:
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        entry = np.zeros((), dtype=INDEX_DTYPE)
+        entry['offset'] = self.file.tell()
+        entry['timestamp'] = timestamp
+        entry['rgb_shape'] = frame.rgb_u8.shape
+        entry['depth_shape'] = frame.depth.shape
+        entry['confidence_shape'] = frame.confidence.shape
+
+        intrinsics = frame.camera.intrinsics
+        entry['intrinsics'] = (intrinsics.fx, intrinsics.fy, intrinsics.px, intrinsics.py)
+        entry['orthographic'] = intrinsics.orthographic
+        entry['position'] = frame.camera.position
+        entry['rotation_matrix'] = frame.camera.rotation_matrix
+
+        for image, dtype in zip((frame.rgb_u8, frame.depth, frame.confidence), _IMAGE_DTYPES):
+            self._write_padded(np.ascontiguousarray(image, dtype=dtype))
+        self.index.append(entry)
+
+    def close(self) -> None:
+        if self.file is None:
+            return
+        index_offset = self.file.tell()
+        self._write_padded(np.array(self.index, dtype=INDEX_DTYPE))
+        self.file.write(_FOOTER.pack(index_offset, len(self.index), MAGIC))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def record(stream: RGBDStream, path: str, duration: Optional[float] = None, max_frames: Optional[int] = None) -> int:
+    '''Records frames from stream until duration seconds have passed,
+    max_frames were written, the stream stops or Ctrl+C is pressed.
+    Returns the frame count.'''
+    if not stream.is_running():
+        stream.start()
+
+    count = 0
+    start = time.monotonic()
+    with RGBDRecorder(path) as recorder:
+        try:
+            while stream.is_running():
+                if duration is not None and time.monotonic() - start >= duration:
+                    break
+                if max_frames is not None and count >= max_frames:
+                    break
+                if not stream.wait_for_frames(timeout=0.1):
+                    continue
+                timestamp = time.monotonic()
+                recorder.write(stream.acquire_frame(), timestamp)
+                count += 1
+        except KeyboardInterrupt:
+            pass
+    return count
+
+
+class RGBDStream_Replay(RGBDStream):
+    '''Replays a recording made by RGBDRecorder.
+
+    With realtime, wait_for_frames() paces frames by their recorded capture
+    times; otherwise frames are returned as fast as they are requested.
+    acquire_frame() returns views of a copy-on-write memory map, so writing
+    to them never touches the file.
+    '''
+
+    def __init__(self, path: str, realtime: bool = True, loop: bool = False) -> None:
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+
+        self.data = np.memmap(path, dtype=np.uint8, mode='c')
+        index_offset, count, magic = _FOOTER.unpack(bytes(self.data[-_FOOTER.size:]))
+        if magic != MAGIC or bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{path} is not a complete RGBD recording')
+        self.index = np.frombuffer(self.data, dtype=INDEX_DTYPE, count=count, offset=index_offset)
+
+        self.streaming = False
+        self.frame_index = -1
+        self._start_time = 0.0
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def timestamps(self) -> NDArray:
+        return self.index['timestamp']
+
+    def start(self) -> None:
+        self.streaming = True
+        self.seek(0)
+
+    def is_running(self) -> bool:
+        return self.streaming
+
+    def stop(self) -> None:
+        self.streaming = False
+
+    def seek(self, frame_index: int) -> None:
+        '''Makes frame_index the next frame returned after wait_for_frames().'''
+        self.frame_index = frame_index - 1
+        self._start_time = time.monotonic()
+        if len(self.index) > 0:
+            self._start_time -= self.timestamps[frame_index] - self.timestamps[0]
+
+    def wait_for_frames(self, timeout: Optional[float] = None) -> bool:
+        if not self.streaming:
+            return False
+
+        next_index = self.frame_index + 1
+        if next_index >= len(self.index):
+            if not self.loop or len(self.index) == 0:
+                self.stop()
+                return False
+            self.seek(0)
+            next_index = 0
+
+        if self.realtime:
+            due = self._start_time + self.timestamps[next_index] - self.timestamps[0]
+            delay = due - time.monotonic()
+            if timeout is not None and delay > timeout:
+                time.sleep(timeout)
+                return False
+            if delay > 0.0:
+                time.sleep(delay)
+
+        self.frame_index = next_index
+        return True
+
+    def _get_images(self, frame_index: int) -> FrameBuffers:
+        entry = self.index[frame_index]
+        offset = int(entry['offset'])
+        images = []
+        for shape, dtype in zip((entry['rgb_shape'], entry['depth_shape'], entry['confidence_shape']), _IMAGE_DTYPES):
+            shape = tuple(int(n) for n in shape)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            images.append(self.data[offset:offset + nbytes].view(dtype).reshape(shape))
+            offset += _aligned(nbytes)
+        return tuple(images)
+
+    def get_camera(self) -> Camera:
+        entry = self.index[max(self.frame_index, 0)]
+        fx, fy, px, py = entry['intrinsics']
+        intrinsics = Intrinsics(1.0, 1.0, fx, fy, px, py, orthographic=bool(entry['orthographic']))
+        return Camera(intrinsics, entry['position'].copy(), entry['rotation_matrix'].copy())
+
+    def get_frame(self) -> RGBDFrame:
+        rgb, depth, confidence = self._get_images(max(self.frame_index, 0))
+        return RGBDFrame(rgb.astype(np.float32) / 255.0, depth.copy(), confidence.copy(), self.get_camera())
+
+    def acquire_frame(self, buffers: Optional[FrameBuffers] = None) -> RGBDFrame:
+        '''Returns views into the recording, or copies into buffers if their
+        shapes match and they are not themselves views into the recording.'''
+        images = self._get_images(max(self.frame_index, 0))
+        if (buffers is not None
+                and [buffer.shape for buffer in buffers] == [image.shape for image in images]
+                and not any(np.may_share_memory(buffer, self.data) for buffer in buffers)):
+            for buffer, image in zip(buffers, images):
+                np.copyto(buffer, image)
+            images = buffers
+        return RGBDFrame(*images, self.get_camera())
+
+
+class RGBDSessionRecorder:
+    '''Records frames to a directory without blocking the caller.
+
+    write() only copies the frame into one of max_pending preallocated
+    buffer sets and returns; one thread encodes RGB into rgb.avi (MJPG) and
+    appends to index.csv, and depth_workers threads write depth (uint16
+    millimeters) and confidence as depth/<frame>.png and
+    confidence/<frame>.png. If the workers fall behind and all buffers are
+    in use, frames are dropped rather than delaying the caller.
+
+    Row n of index.csv describes video frame n: its timestamp (time.time()
+    unless given, to join with controller logs), the camera position and
+    rotation and its normalized intrinsics.
+    '''
+
+    INDEX_COLUMNS = (['frame', 'timestamp', 'p_x', 'p_y', 'p_z']
+                     + [f'r_{i}{j}' for i in range(3) for j in range(3)]
+                     + ['fx', 'fy', 'px', 'py'])
+
+    def __init__(self, directory: str, fps: float = 30.0, max_pending: int = 8, depth_workers: int = 2) -> None:
+        self.directory = directory
+        self.fps = fps
+        self.max_pending = max_pending
+        os.makedirs(os.path.join(directory, 'depth'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'confidence'), exist_ok=True)
+
+        self.written_count = 0
+        self.dropped_count = 0
+
+        self._buffers: List[FrameBuffers] = []
+        self._free: List[int] = []
+        # Buffer set index -> number of workers still using it
+        self._pending_jobs: List[int] = []
+        self._buffer_lock = threading.Lock()
+
+        self._rgb_jobs = queue.Queue()
+        self._depth_jobs = queue.Queue()
+        self._threads = [threading.Thread(target=self._rgb_loop, daemon=True)]
+        self._threads += [threading.Thread(target=self._depth_loop, daemon=True) for _ in range(depth_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _allocate_buffers(self, frame: RGBDFrame) -> None:
+        self._buffers = [(np.empty_like(frame.rgb_u8), np.empty(frame.depth.shape, dtype=np.uint16),
+                          np.empty_like(frame.confidence)) for _ in range(self.max_pending)]
+        self._free = list(range(self.max_pending))
+        self._pending_jobs = [0] * self.max_pending
+
+    def write(self, frame: RGBDFrame, timestamp: Optional[float] = None) -> bool:
+        '''Queues frame for writing. Returns False if it was dropped.'''
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._buffer_lock:
+            if not self._buffers:
+                self._allocate_buffers(frame)
+            if not self._free:
+                self.dropped_count += 1
+                return False
+            index = self._free.pop()
+            self._pending_jobs[index] = 2
+        bgr, depth, confidence = self._buffers[index]
+        if bgr.shape != frame.rgb_u8.shape or depth.shape != frame.depth.shape:
+            raise ValueError('Frame size changed during recording')
+
+        cv2.cvtColor(frame.rgb_u8, cv2.COLOR_RGB2BGR, dst=bgr)
+        np.multiply(np.clip(frame.depth, 0.0, 65.535), 1000.0, out=depth, casting='unsafe')
+        np.copyto(confidence, frame.confidence)
+
+        frame_number = self.written_count
+        self.written_count += 1
+        camera = frame.camera
+        intrinsics = camera.intrinsics
+        row = ([frame_number, timestamp] + list(camera.position) + list(np.ravel(camera.rotation_matrix))
+               + [intrinsics.fx, intrinsics.fy, intrinsics.px, intrinsics.py])
+
+        self._rgb_jobs.put((index, row))
+        self._depth_jobs.put((index, frame_number))
+        return True
+
+    def _release(self, index: int) -> None:
+        with self._buffer_lock:
+            self._pending_jobs[index] -= 1
+            if self._pending_jobs[index] == 0:
+                self._free.append(index)
+
+    def _rgb_loop(self) -> None:
+        writer = None
+        with open(os.path.join(self.directory, 'index.csv'), 'w', newline='') as index_file:
+            index_writer = csv.writer(index_file)
+            index_writer.writerow(self.INDEX_COLUMNS)
+            while True:
+                job = self._rgb_jobs.get()
+                if job is None:
+                    break
+                index, row = job
+                bgr = self._buffers[index][0]
+                if writer is None:
+                    writer = cv2.VideoWriter(
+                        os.path.join(self.directory, 'rgb.avi'), cv2.VideoWriter_fourcc(*'MJPG'),
+                        self.fps, (bgr.shape[1], bgr.shape[0]))
+                writer.write(bgr)
+                self._release(index)
+                index_writer.writerow(row)
+        if writer is not None:
+            writer.release()
+
+    def _depth_loop(self) -> None:
+        while True:
+            job = self._depth_jobs.get()
+            if job is None:
+                break
+            index, frame_number = job
+            _, depth, confidence = self._buffers[index]
+            cv2.imwrite(os.path.join(self.directory, 'depth', f'{frame_number:06d}.png'), depth)
+            cv2.imwrite(os.path.join(self.directory, 'confidence', f'{frame_number:06d}.png'), confidence)
+            self._release(index)
+
+    def close(self) -> None:
+        '''Writes everything still queued and stops the workers.'''
+        if not self._threads:
+            return
+        self._rgb_jobs.put(None)
+        for _ in self._threads[1:]:
+            self._depth_jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record frames from an iOS device running Record3D')
+    parser.add_argument('path')
+    parser.add_argument('--device-index', type=int, default=0)
+    parser.add_argument('--duration', type=float, default=None, help='seconds to record for')
+    parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+
+    stream = RGBDStream_iOS(args.device_index)
+    count = record(stream, args.path, args.duration, args.max_frames)
+    print(f'Recorded {count} frame(s) to {args.path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 import numpy as np
-from typing import Tuple
+from functools import cached_property
+from typing import Dict, Optional, Tuple
 from numpy.typing import NDArray
-from record3d import Record3DStream
 from threading import Event
 import cv2
 from camera import Camera, Intrinsics
@@ -22,23 +22,130 @@ def quaternion_to_matrix(quaternion: NDArray) -> NDArray:
     ])
 
 
+# Destination arrays for one frame: uint8 RGB, depth, confidence
+FrameBuffers = Tuple[NDArray, NDArray, NDArray]
+
+# Mapping: (height, width) -> read-only (height, width, 2) pixel centers
+_pixel_grids: Dict[Tuple[int, int], NDArray] = {}
+
+
+def get_pixel_grid(height: int, width: int) -> NDArray:
+    key = (height, width)
+    grid = _pixel_grids.get(key)
+    if grid is None:
+        x, y = np.meshgrid(np.arange(width), np.arange(height))
+        grid = np.stack([x + 0.5, y + 0.5], axis=-1)
+        grid.setflags(write=False)
+        _pixel_grids[key] = grid
+    return grid
+
+
 class RGBDFrame:
-    def __init__(self, rgb: NDArray, depth: NDArray, confidence: NDArray, camera: Camera) -> None:
-        self.rgb = rgb
+    def __init__(self, rgb: NDArray, depth: NDArray, confidence: NDArray, camera: Camera,
+                 offset: Tuple[int, int] = (0, 0), full_shape: Optional[Tuple[int, int]] = None) -> None:
+        # rgb is either float in [0, 1] or uint8; the other representation
+        # is derived on first access.
+        if rgb.dtype == np.uint8:
+            self.rgb_u8 = rgb
+        else:
+            self.rgb = rgb
         self.depth = depth
         self.confidence = confidence
         self.camera = camera
 
-        self.resized_rgb = cv2.resize(rgb, np.flip(depth.shape))
-        self.resized_depth = cv2.resize(depth, np.flip(rgb.shape[0:2]))
-
-        x, y = np.meshgrid(
-            np.arange(depth.shape[1]), np.arange(depth.shape[0]))
-        self.xyz = np.stack([x + 0.5, y + 0.5, depth], axis=-1)
+        # For frames cropped to a region of interest: the (row, column) of
+        # the crop and the (height, width) of the full depth image. Pixel
+        # coordinates are always full-frame ones.
+        self.offset = offset
+        self.full_shape = depth.shape if full_shape is None else full_shape
+
+    # The derived buffers below are computed on first access only.
+
+    @cached_property
+    def rgb(self) -> NDArray:
+        return np.multiply(self.rgb_u8, np.float32(1.0 / 255.0), dtype=np.float32)
+
+    @cached_property
+    def rgb_u8(self) -> NDArray:
+        return (self.rgb * 255.0).astype(np.uint8)
+
+    @cached_property
+    def resized_rgb(self) -> NDArray:
+        return cv2.resize(self.rgb, self.depth.shape[::-1])
+
+    @cached_property
+    def resized_depth(self) -> NDArray:
+        # Only the size of the RGB image is needed; don't convert it for that.
+        return cv2.resize(self.depth, self._existing_rgb().shape[1::-1])
+
+    @cached_property
+    def xyz(self) -> NDArray:
+        height, width = self.depth.shape
+        xyz = np.empty((height, width, 3), dtype=np.result_type(self.depth, np.float64))
+        xyz[..., 0:2] = get_pixel_grid(height, width)
+        if self.offset != (0, 0):
+            xyz[..., 0] += self.offset[1]
+            xyz[..., 1] += self.offset[0]
+        xyz[..., 2] = self.depth
+        return xyz
+
+    def _existing_rgb(self) -> NDArray:
+        '''Returns whichever RGB representation already exists.'''
+        return self.__dict__.get('rgb_u8', self.__dict__.get('rgb'))
+
+    def get_roi(self, box_min: NDArray, box_max: NDArray, margin: int = 0) -> Optional[Tuple[int, int, int, int]]:
+        '''Returns the full-frame depth pixel bounds (top, bottom, left,
+        right) of the world-space box, grown by margin pixels and clipped to
+        this frame, or None if the box is not in view.'''
+        corners = np.array([[x, y, z] for x in (box_min[0], box_max[0])
+                            for y in (box_min[1], box_max[1]) for z in (box_min[2], box_max[2])])
+        xyz = self.camera.world_to_screen(corners, self.full_shape[1], self.full_shape[0])
+
+        top, left = self.offset
+        bottom, right = top + self.depth.shape[0], left + self.depth.shape[1]
+        if (xyz[:, 2] <= 0.0).all():
+            return None
+        if (xyz[:, 2] > 0.0).all():
+            # Otherwise the box straddles the camera plane and its projection
+            # is unbounded, so keep the whole frame.
+            top = max(top, int(np.floor(xyz[:, 1].min())) - margin)
+            bottom = min(bottom, int(np.ceil(xyz[:, 1].max())) + margin)
+            left = max(left, int(np.floor(xyz[:, 0].min())) - margin)
+            right = min(right, int(np.ceil(xyz[:, 0].max())) + margin)
+        if top >= bottom or left >= right:
+            return None
+        return top, bottom, left, right
+
+    def crop(self, roi: Tuple[int, int, int, int]) -> 'RGBDFrame':
+        '''Returns a frame of views into the given full-frame region of this
+        one, on which all geometry works unchanged and in full-frame pixel
+        coordinates. RGB is cropped to the matching region. Carving only
+        tests against the cropped depth, so points projecting outside the
+        crop are kept.'''
+        top, bottom, left, right = roi
+        rows = slice(top - self.offset[0], bottom - self.offset[0])
+        columns = slice(left - self.offset[1], right - self.offset[1])
+
+        rgb = self._existing_rgb()
+        scale_y = rgb.shape[0] / self.depth.shape[0]
+        scale_x = rgb.shape[1] / self.depth.shape[1]
+        rgb = rgb[int(round(rows.start * scale_y)):int(round(rows.stop * scale_y)),
+                  int(round(columns.start * scale_x)):int(round(columns.stop * scale_x))]
+
+        return RGBDFrame(rgb, self.depth[rows, columns], self.confidence[rows, columns], self.camera,
+                         offset=(top, left), full_shape=self.full_shape)
+
+    def uncrop(self, values: NDArray, fill_value=0) -> NDArray:
+        '''Places per-pixel values of this (cropped) frame into an array the
+        size of the full depth image.'''
+        full = np.full(self.full_shape + values.shape[2:], fill_value, dtype=values.dtype)
+        top, left = self.offset
+        full[top:top + values.shape[0], left:left + values.shape[1]] = values
+        return full
 
     def compute_XYZ(self) -> None:
         self.XYZ = self.camera.screen_to_world(
-            self.xyz, self.depth.shape[1], self.depth.shape[0])
+            self.xyz, self.full_shape[1], self.full_shape[0])
 
     def get_normals(self) -> NDArray:
         down_shift_XYZ = np.roll(self.XYZ, 1, axis=0)
@@ -60,7 +167,10 @@ class RGBDFrame:
 
     def get_carved_points_mask(self, XYZ: NDArray) -> NDArray:
         xyz = self.camera.world_to_screen(
-            XYZ, self.depth.shape[1], self.depth.shape[0])
+            XYZ, self.full_shape[1], self.full_shape[0])
+        if self.offset != (0, 0):
+            xyz[..., 0] -= self.offset[1]
+            xyz[..., 1] -= self.offset[0]
 
         is_valid = (xyz[..., 0] < 0.0) | (xyz[..., 0] >= self.depth.shape[1])
         is_valid |= (xyz[..., 1] < 0.0) | (xyz[..., 1] >= self.depth.shape[0])
@@ -95,15 +205,32 @@ class RGBDStream:
     def stop(self) -> None:
         raise NotImplementedError()
 
-    def wait_for_frames(self) -> None:
+    def wait_for_frames(self, timeout: Optional[float] = None) -> bool:
+        '''Blocks until a new frame is available. Returns False if timeout
+        seconds passed without one.'''
         raise NotImplementedError()
 
     def get_frame(self) -> RGBDFrame:
         raise NotImplementedError()
 
+    def acquire_frame(self, buffers: Optional[FrameBuffers] = None) -> RGBDFrame:
+        '''Returns the next frame, written into buffers (uint8 RGB, depth,
+        confidence) when given and the backend supports reusing them.'''
+        return self.get_frame()
+
+
+def _rotate_into(src: NDArray, dst: NDArray) -> NDArray:
+    if src.dtype == dst.dtype:
+        return cv2.rotate(src, cv2.ROTATE_90_COUNTERCLOCKWISE, dst=dst)
+    np.copyto(dst, cv2.rotate(src, cv2.ROTATE_90_COUNTERCLOCKWISE))
+    return dst
+
 
 class RGBDStream_iOS(RGBDStream):
-    def __init__(self, device_index=0) -> None:
+    def __init__(self, device_index=0, pool_size=3) -> None:
+        # Imported here so other backends work without record3d installed.
+        from record3d import Record3DStream
+
         devices = Record3DStream.get_connected_devices()
         print('{} device(s) found'.format(len(devices)))
         for device in devices:
@@ -123,6 +250,15 @@ class RGBDStream_iOS(RGBDStream):
         self.event = Event()
         self.streaming = False
 
+        # Buffer sets reused round-robin by acquire_frame()
+        self.pool_size = pool_size
+        self._pool = []
+        self._pool_index = 0
+
+        self._rgb_shape = None
+        self._intrinsics_key = None
+        self._intrinsics = None
+
     def on_new_frame(self) -> None:
         self.event.set()
 
@@ -135,12 +271,15 @@ class RGBDStream_iOS(RGBDStream):
     def stop(self) -> None:
         self.streaming = False
 
-    def wait_for_frames(self) -> None:
-        self.event.wait()
+    def wait_for_frames(self, timeout: Optional[float] = None) -> bool:
+        if not self.event.wait(timeout):
+            return False
         self.event.clear()
+        return True
 
     def _get_rgb_frame(self) -> NDArray:
         rgb = self.session.get_rgb_frame()
+        self._rgb_shape = rgb.shape
         rgb = cv2.rotate(rgb, cv2.ROTATE_90_COUNTERCLOCKWISE)
         return rgb.astype(np.float32) / 255.0
 
@@ -154,27 +293,35 @@ class RGBDStream_iOS(RGBDStream):
         confidence = cv2.rotate(confidence, cv2.ROTATE_90_COUNTERCLOCKWISE)
         return confidence
 
-    def get_camera(self) -> Camera:
+    def _get_intrinsics(self, rgb_shape: Tuple[int, ...]) -> Intrinsics:
         intrinsics = self.session.get_intrinsic_mat()
+        key = (intrinsics.fx, intrinsics.fy, intrinsics.tx, intrinsics.ty, rgb_shape[:2])
+        if key != self._intrinsics_key:
+            self._intrinsics = Intrinsics(
+                width=rgb_shape[0], height=rgb_shape[1],
+                fx=intrinsics.fy, fy=intrinsics.fx,
+                px=intrinsics.ty, py=rgb_shape[1] - 1 - intrinsics.tx)
+            self._intrinsics_key = key
+        return self._intrinsics
+
+    def get_camera(self) -> Camera:
         extrinsics = self.session.get_camera_pose()
 
-        rgb_shape = self.session.get_rgb_frame().shape
-        intrinsics = Intrinsics(
-            width=rgb_shape[0], height=rgb_shape[1],
-            fx=intrinsics.fy, fy=intrinsics.fx,
-            px=intrinsics.ty, py=rgb_shape[1] - 1 - intrinsics.tx)
+        if self._rgb_shape is None:
+            self._rgb_shape = self.session.get_rgb_frame().shape
+        intrinsics = self._get_intrinsics(self._rgb_shape)
 
         position = np.array([extrinsics.tx, -extrinsics.ty, -extrinsics.tz])
         quaternion = np.array(
             [extrinsics.qx, -extrinsics.qy, -extrinsics.qz, extrinsics.qw])
 
-        camera = Camera(intrinsics, position, quaternion_to_matrix(quaternion))
-        camera.inverse_rotation_matrix[[0, 1]] = \
-            camera.inverse_rotation_matrix[[1, 0]]
-        camera.inverse_rotation_matrix[1] *= -1.0
-        camera.rotation_matrix = np.linalg.inv(camera.inverse_rotation_matrix)
+        # Rotation matrices are orthonormal, so transposes replace inverses.
+        inverse_rotation_matrix = quaternion_to_matrix(quaternion).T
+        inverse_rotation_matrix[[0, 1]] = inverse_rotation_matrix[[1, 0]]
+        inverse_rotation_matrix[1] *= -1.0
 
-        return camera
+        return Camera(intrinsics, position, inverse_rotation_matrix.T.copy(),
+                      inverse_rotation_matrix=inverse_rotation_matrix)
 
     def get_frame(self) -> RGBDFrame:
         rgb = self._get_rgb_frame()
@@ -182,3 +329,39 @@ class RGBDStream_iOS(RGBDStream):
         confidence = self._get_confidence_frame()
         camera = self.get_camera()
         return RGBDFrame(rgb, depth, confidence, camera)
+
+    def _next_buffers(self, rgb: NDArray, depth: NDArray, confidence: NDArray) -> Tuple[NDArray, NDArray, NDArray]:
+        shapes = [(src.shape[1], src.shape[0]) + src.shape[2:]
+                  for src in (rgb, depth, confidence)]
+        if not self._pool or [buffer.shape for buffer in self._pool[0]] != shapes:
+            dtypes = (np.uint8, np.float32, confidence.dtype)
+            self._pool = [tuple(np.empty(shape, dtype=dtype) for shape, dtype in zip(shapes, dtypes))
+                          for _ in range(self.pool_size)]
+            self._pool_index = 0
+        buffers = self._pool[self._pool_index]
+        self._pool_index = (self._pool_index + 1) % self.pool_size
+        return buffers
+
+    def acquire_frame(self, buffers: Optional[FrameBuffers] = None) -> RGBDFrame:
+        '''Like get_frame(), but rotates into reused buffers and keeps RGB as
+        uint8 until frame.rgb is accessed.
+
+        Without buffers, a pool of pool_size buffer sets is used round-robin,
+        so the returned frame is overwritten after pool_size more frames
+        have been acquired; copy anything that must live longer.
+        '''
+        rgb = self.session.get_rgb_frame()
+        depth = self.session.get_depth_frame()
+        confidence = self.session.get_confidence_frame()
+        self._rgb_shape = rgb.shape
+
+        shapes = [(src.shape[1], src.shape[0]) + src.shape[2:]
+                  for src in (rgb, depth, confidence)]
+        if buffers is None or [buffer.shape for buffer in buffers] != shapes:
+            buffers = self._next_buffers(rgb, depth, confidence)
+        rgb_buffer, depth_buffer, confidence_buffer = buffers
+        return RGBDFrame(
+            _rotate_into(rgb, rgb_buffer),
+            _rotate_into(depth, depth_buffer),
+            _rotate_into(confidence, confidence_buffer),
+            self.get_camera())
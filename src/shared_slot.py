@@ -0,0 +1,150 @@
+from multiprocessing import shared_memory, resource_tracker
+from typing import Any, Dict, Optional, Tuple
+import os
+import time
+from numpy.typing import DTypeLike, NDArray
+import numpy as np
+
+# Mapping: field name -> (shape, dtype)
+FieldSpec = Dict[str, Tuple[Tuple[int, ...], DTypeLike]]
+
+_ALIGNMENT = 64
+
+
+def _aligned(nbytes: int) -> int:
+    return -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+
+
+class SharedSlot:
+    '''A fixed-layout record of NumPy arrays in shared memory.
+
+    A 64-bit sequence counter in the header makes it a seqlock: the single
+    writer makes the counter odd while it writes and even again when done,
+    so readers in other processes can always get the latest complete value
+    without locks or pickling. Send spec() to the other process and rebuild
+    the slot there with SharedSlot.attach().
+    '''
+
+    def __init__(self, fields: FieldSpec, name: Optional[str] = None) -> None:
+        self.fields = {field: (tuple(int(n) for n in shape), np.dtype(dtype).str)
+                       for field, (shape, dtype) in fields.items()}
+
+        size = _ALIGNMENT + sum(
+            _aligned(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            for shape, dtype in self.fields.values())
+
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = _attach_untracked(name)
+
+        self._seq = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+        if self.owner:
+            self._seq[0] = 0
+
+        self.views: Dict[str, NDArray] = {}
+        offset = _ALIGNMENT
+        for field, (shape, dtype) in self.fields.items():
+            self.views[field] = np.ndarray(
+                shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            offset += _aligned(self.views[field].nbytes)
+
+    @classmethod
+    def attach(cls, spec: Dict[str, Any]) -> 'SharedSlot':
+        return cls(spec['fields'], spec['name'])
+
+    def spec(self) -> Dict[str, Any]:
+        return {'name': self.shm.name, 'fields': self.fields}
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def seq(self) -> int:
+        return int(self._seq[0])
+
+    def begin_write(self) -> None:
+        self._seq[0] += 1
+
+    def end_write(self) -> int:
+        self._seq[0] += 1
+        return int(self._seq[0])
+
+    def write(self, **values: Any) -> int:
+        self.begin_write()
+        for field, value in values.items():
+            self.views[field][...] = value
+        return self.end_write()
+
+    def read_views(self, timeout: Optional[float] = 1.0) -> Tuple[Optional[int], Dict[str, NDArray]]:
+        '''Returns the sequence number and zero-copy views of all fields.
+
+        The views are only consistent if the sequence number is unchanged
+        after they have been used; see is_current(). Waits at most timeout
+        seconds (None: forever) for a write in progress to finish, and
+        returns None as the sequence number if it did not, e.g. because the
+        writer died halfway.
+        '''
+        seq = self.seq
+        if seq % 2 == 1:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while seq % 2 == 1:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None, self.views
+                # Yield instead of spinning at full speed on one core.
+                time.sleep(0)
+                seq = self.seq
+        return seq, self.views
+
+    def is_current(self, seq: int) -> bool:
+        return self.seq == seq
+
+    def read(self, out: Optional[Dict[str, NDArray]] = None,
+             timeout: Optional[float] = 1.0) -> Tuple[Optional[int], Dict[str, NDArray]]:
+        '''Copies a consistent snapshot of all fields, into out if given.
+
+        Returns None as the sequence number if no consistent snapshot could
+        be taken within timeout seconds (None: forever); out may then hold a
+        torn copy, so keep the last good one elsewhere if it is needed.
+        timeout=0 makes a single attempt.
+        '''
+        if out is None:
+            out = {field: np.empty_like(view) for field, view in self.views.items()}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            seq, views = self.read_views(remaining)
+            if seq is None:
+                return None, out
+            for field, view in views.items():
+                np.copyto(out[field], view)
+            if self.is_current(seq):
+                return seq, out
+            if deadline is not None and time.monotonic() >= deadline:
+                return None, out
+
+    def close(self) -> None:
+        self.views = {}
+        self._seq = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Someone still holds a view; the mapping goes away with them.
+            pass
+        if self.owner:
+            self.shm.unlink()
+            self.owner = False
+
+
+def _attach_untracked(name: str) -> shared_memory.SharedMemory:
+    # Only the creating process may unlink the segment, so attached
+    # segments must not be registered with this process' resource tracker.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name != 'nt':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
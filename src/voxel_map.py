@@ -0,0 +1,243 @@
+from typing import Optional, Tuple
+from rgbd_stream import RGBDFrame
+from numpy.typing import NDArray
+import numpy as np
+import time
+
+_EMPTY = np.int64(-1)
+# Voxel coordinates are packed into 21 bits per axis
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+_KEY_MASK = (1 << _KEY_BITS) - 1
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def pack_keys(voxels: NDArray) -> NDArray:
+    voxels = voxels.astype(np.int64) + _KEY_OFFSET
+    return (voxels[..., 0] << (2 * _KEY_BITS)) | (voxels[..., 1] << _KEY_BITS) | voxels[..., 2]
+
+
+def unpack_keys(keys: NDArray) -> NDArray:
+    voxels = np.stack([keys >> (2 * _KEY_BITS), keys >> _KEY_BITS, keys], axis=-1)
+    return (voxels & _KEY_MASK) - _KEY_OFFSET
+
+
+class VoxelMap:
+    '''Occupancy map of the workspace, fused incrementally from RGBD frames.
+
+    Voxels live in a fixed-capacity open-addressing hash table keyed by
+    their packed integer coordinates, with log-odds occupancy and mean color
+    per voxel. integrate() raises the occupancy of voxels containing
+    confident points and lowers it for voxels the camera sees through, using
+    the same test as RGBDFrame.get_carved_points_mask(). Once max_voxels is
+    exceeded, the least occupied, least recently seen voxels are evicted,
+    so memory use is bounded. Eviction rebuilds the table, so it frees
+    evict_fraction of max_voxels at once rather than just enough for the
+    current frame, and runs only every so many frames once the map is full.
+
+    Only every stride-th depth pixel in each direction is fused, and with
+    max_update_rate set, integrate() skips frames arriving sooner than
+    1 / max_update_rate seconds after the last fused one.
+    '''
+
+    def __init__(
+        self,
+        voxel_size: float = 0.02,
+        max_voxels: int = 200_000,
+        stride: int = 4,
+        min_confidence: int = 1,
+        max_update_rate: Optional[float] = None,
+        log_odds_hit: float = 0.85,
+        log_odds_miss: float = -0.4,
+        log_odds_min: float = -2.0,
+        log_odds_max: float = 3.5,
+        evict_fraction: float = 0.1,
+    ) -> None:
+        self.voxel_size = voxel_size
+        self.max_voxels = max_voxels
+        self.evict_fraction = evict_fraction
+        self.stride = stride
+        self.min_confidence = min_confidence
+        self.max_update_rate = max_update_rate
+        self.log_odds_hit = log_odds_hit
+        self.log_odds_miss = log_odds_miss
+        self.log_odds_min = log_odds_min
+        self.log_odds_max = log_odds_max
+
+        # At most half full, so probe sequences stay short
+        self.capacity = 1 << int(np.ceil(np.log2(2 * max_voxels)))
+        self._hash_shift = np.uint64(64 - int(np.log2(self.capacity)))
+        self.keys = np.full(self.capacity, _EMPTY, dtype=np.int64)
+        self.log_odds = np.zeros(self.capacity, dtype=np.float32)
+        self.colors = np.zeros((self.capacity, 3), dtype=np.float32)
+        self.weights = np.zeros(self.capacity, dtype=np.float32)
+        self.last_seen = np.zeros(self.capacity, dtype=np.int64)
+        self.count = 0
+
+        self.update_count = 0
+        self.eviction_count = 0
+        self.last_update_time = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def clear(self) -> None:
+        self.keys.fill(_EMPTY)
+        self.log_odds.fill(0.0)
+        self.colors.fill(0.0)
+        self.weights.fill(0.0)
+        self.last_seen.fill(0)
+        self.count = 0
+
+    def _hash(self, keys: NDArray) -> NDArray:
+        return ((keys.astype(np.uint64) * _HASH_MULTIPLIER) >> self._hash_shift).astype(np.int64)
+
+    def _lookup(self, keys: NDArray) -> NDArray:
+        '''Returns the table slot of each key, or -1 where it is missing.'''
+        slots = np.full(len(keys), -1, dtype=np.int64)
+        probes = self._hash(keys)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            probe = probes[pending]
+            stored = self.keys[probe]
+            found = stored == keys[pending]
+            slots[pending[found]] = probe[found]
+            pending = pending[~(found | (stored == _EMPTY))]
+            probes[pending] = (probes[pending] + 1) & (self.capacity - 1)
+        return slots
+
+    def _insert(self, keys: NDArray) -> NDArray:
+        '''Inserts unique keys that are not in the table yet and returns
+        their slots.'''
+        slots = np.empty(len(keys), dtype=np.int64)
+        probes = self._hash(keys)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            probe = probes[pending]
+            is_free = self.keys[probe] == _EMPTY
+            # Several keys may probe the same free slot; the first one wins.
+            free_slots, first = np.unique(probe[is_free], return_index=True)
+            winners = pending[is_free][first]
+            self.keys[free_slots] = keys[winners]
+            slots[winners] = free_slots
+
+            won = np.zeros(len(keys), dtype=bool)
+            won[winners] = True
+            pending = pending[~won[pending]]
+            probes[pending] = (probes[pending] + 1) & (self.capacity - 1)
+
+        self.log_odds[slots] = 0.0
+        self.colors[slots] = 0.0
+        self.weights[slots] = 0.0
+        self.count += len(keys)
+        return slots
+
+    def _evict(self, keep: int) -> None:
+        '''Rebuilds the table with only the keep most occupied voxels, the
+        most recently seen first among equals.'''
+        self.eviction_count += 1
+        slots = np.flatnonzero(self.keys != _EMPTY)
+        order = np.lexsort((-self.last_seen[slots], -self.log_odds[slots]))
+        slots = slots[order[:keep]]
+
+        keys = self.keys[slots]
+        log_odds = self.log_odds[slots]
+        colors = self.colors[slots]
+        weights = self.weights[slots]
+        last_seen = self.last_seen[slots]
+
+        self.clear()
+        new_slots = self._insert(keys)
+        self.log_odds[new_slots] = log_odds
+        self.colors[new_slots] = colors
+        self.weights[new_slots] = weights
+        self.last_seen[new_slots] = last_seen
+
+    def _get_points(self, frame: RGBDFrame) -> Tuple[NDArray, NDArray]:
+        s = self.stride
+        height, width = frame.full_shape
+        is_valid = frame.confidence[::s, ::s] >= self.min_confidence
+        is_valid &= frame.depth[::s, ::s] > 0.0
+
+        xyz = frame.xyz[::s, ::s][is_valid]
+        XYZ = frame.camera.screen_to_world(xyz, width, height)
+        rgb = frame.resized_rgb[::s, ::s][is_valid]
+        return XYZ, rgb
+
+    def integrate(self, frame: RGBDFrame, now: Optional[float] = None) -> bool:
+        '''Fuses frame into the map. Returns False if it was skipped because
+        of max_update_rate.'''
+        if now is None:
+            now = time.monotonic()
+        if (self.max_update_rate is not None and self.last_update_time is not None
+                and now - self.last_update_time < 1.0 / self.max_update_rate):
+            return False
+        self.last_update_time = now
+        self.update_count += 1
+
+        XYZ, rgb = self._get_points(frame)
+        keys = pack_keys(np.floor(XYZ / self.voxel_size))
+        keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+
+        # Carve before adding hits, so a voxel that this frame both hits and
+        # (within the depth margin) sees through still gains occupancy.
+        self._carve(frame)
+
+        slots = self._lookup(keys)
+        is_new = slots < 0
+        n_new = int(np.count_nonzero(is_new))
+        if self.count + n_new > self.max_voxels:
+            # Down to a low-water mark, so the next frames fit without
+            # another rebuild.
+            low_water = int((1.0 - self.evict_fraction) * self.max_voxels)
+            self._evict(max(min(low_water, self.max_voxels) - n_new, 0))
+            slots = self._lookup(keys)
+            is_new = slots < 0
+            n_new = int(np.count_nonzero(is_new))
+        excess = self.count + n_new - self.max_voxels
+        if excess > 0:
+            # Eviction also dropped voxels of this frame, or the frame alone
+            # does not fit; skip the new voxels with the fewest points.
+            dropped = np.flatnonzero(is_new)[np.argsort(counts[is_new], kind='stable')[:excess]]
+            is_new[dropped] = False
+        slots[is_new] = self._insert(keys[is_new])
+
+        kept = slots >= 0
+        slots, counts = slots[kept], counts[kept]
+        self.log_odds[slots] = np.minimum(self.log_odds[slots] + self.log_odds_hit, self.log_odds_max)
+        self.last_seen[slots] = self.update_count
+
+        color_sums = np.stack([np.bincount(inverse, weights=rgb[:, c], minlength=len(kept))
+                               for c in range(3)], axis=-1)[kept]
+        weights = self.weights[slots]
+        self.colors[slots] = (self.colors[slots] * weights[:, None] + color_sums) / (weights + counts)[:, None]
+        self.weights[slots] = weights + counts
+        return True
+
+    def _carve(self, frame: RGBDFrame) -> None:
+        slots = np.flatnonzero((self.keys != _EMPTY) & (self.log_odds > self.log_odds_min))
+        if len(slots) == 0:
+            return
+        is_kept = frame.get_carved_points_mask(self.voxel_centers(self.keys[slots]))
+        carved = slots[~is_kept]
+        self.log_odds[carved] = np.maximum(self.log_odds[carved] + self.log_odds_miss, self.log_odds_min)
+
+    def voxel_centers(self, keys: NDArray) -> NDArray:
+        return (unpack_keys(keys) + 0.5) * self.voxel_size
+
+    def get_log_odds(self, points: NDArray) -> NDArray:
+        '''Returns the log-odds occupancy of the voxels containing points,
+        0 (unknown) for voxels not in the map.'''
+        points = np.asarray(points)
+        slots = self._lookup(pack_keys(np.floor(points.reshape(-1, 3) / self.voxel_size)))
+        log_odds = np.where(slots >= 0, self.log_odds[slots], 0.0)
+        return log_odds.reshape(points.shape[:-1])
+
+    def is_occupied(self, points: NDArray, threshold: float = 0.0) -> NDArray:
+        return self.get_log_odds(points) > threshold
+
+    def get_occupied_voxels(self, threshold: float = 0.0) -> Tuple[NDArray, NDArray]:
+        '''Returns the centers and mean colors of all occupied voxels.'''
+        slots = np.flatnonzero((self.keys != _EMPTY) & (self.log_odds > threshold))
+        return self.voxel_centers(self.keys[slots]), self.colors[slots]
@@ -0,0 +1,9 @@
+# Tests import modules from src/ directly, as the notebooks do via preamble.py
+
+import sys
+import os
+
+src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+if src_path not in sys.path:
+    sys.path.append(src_path)
@@ -0,0 +1,50 @@
+import numpy as np
+from incremental_kabsch import IncrementalKabsch
+
+
+def random_rotation(rng):
+    Q, R = np.linalg.qr(rng.normal(size=(3, 3)))
+    Q *= np.sign(np.diag(R))
+    if np.linalg.det(Q) < 0:
+        Q[:, 0] *= -1
+    return Q
+
+
+def make_pairs(rng, P, noise=0.001):
+    R = random_rotation(rng)
+    t = rng.normal(size=3)
+    Q = P @ R.T + t + rng.normal(scale=noise, size=P.shape)
+    return R, t, Q
+
+
+def test_collinear_pairs_never_converge():
+    rng = np.random.default_rng(0)
+    direction = np.array([1.0, 2.0, 0.5]) / np.linalg.norm([1.0, 2.0, 0.5])
+    P = rng.uniform(-0.2, 0.2, size=(2000, 1)) * direction
+    _, _, Q = make_pairs(rng, P)
+
+    solver = IncrementalKabsch(seed=0)
+    for p, q in zip(P, Q):
+        solver.add(p, q)
+    assert not solver.converged
+    assert not solver.is_well_spread()
+
+
+def test_clustered_start_does_not_lock_in():
+    rng = np.random.default_rng(1)
+    # The marker first sits nearly still, then the motion spreads out.
+    clustered = rng.normal(scale=0.002, size=(100, 3))
+    spread = rng.uniform(-0.15, 0.15, size=(2000, 3))
+    P = np.vstack([clustered, spread])
+    R, t, Q = make_pairs(rng, P)
+
+    solver = IncrementalKabsch(seed=1)
+    for i, (p, q) in enumerate(zip(P, Q)):
+        solver.add(p, q)
+        if i < len(clustered):
+            # No model from bunched points alone
+            assert solver.count == 0
+    assert solver.converged
+    fitted_R, fitted_t = solver.solve()
+    assert np.allclose(fitted_R, R, atol=1e-2)
+    assert np.allclose(fitted_t, t, atol=1e-2)
@@ -0,0 +1,48 @@
+from collections import deque
+import threading
+
+import numpy as np
+
+from plot_client import PlotClient
+
+
+def make_queued_client(max_queue_size):
+    '''Returns an asynchronous client without a connection or sender thread,
+    so sent messages stay in its queue.'''
+    client = PlotClient.__new__(PlotClient)
+    client.asynchronous = True
+    client.max_queue_size = max_queue_size
+    client.sent_count = 0
+    client.dropped_count = 0
+    client.merged_count = 0
+    client.shared_memory_threshold = None
+    client.timestamp_messages = False
+    client._queue = deque()
+    client._queue_condition = threading.Condition()
+    return client
+
+
+def test_append_does_not_overwrite_queued_replace():
+    client = make_queued_client(max_queue_size=2)
+    x, y = np.arange(10.0), np.ones(10)
+    client.create_plot("p")
+    client.update_line("p", "l", (x, y), mode="replace")
+    client.update_line("p", "l", (np.array([10.0]), np.array([2.0])))
+
+    assert [msg["action"] for msg in client._queue] == ["create", "update_line"]
+    replace = client._queue[1]
+    assert replace["mode"] == "replace"
+    assert replace["data"][0] is x and replace["data"][1] is y
+    assert client.dropped_count == 1
+
+
+def test_replace_supersedes_queued_replace_in_place():
+    client = make_queued_client(max_queue_size=2)
+    client.create_plot("p")
+    client.update_line("p", "l", (np.arange(3.0), np.zeros(3)), mode="replace")
+    x, y = np.arange(5.0), np.ones(5)
+    client.update_line("p", "l", (x, y), mode="replace")
+
+    assert [msg["action"] for msg in client._queue] == ["create", "update_line"]
+    assert client._queue[1]["data"][0] is x
+    assert client.dropped_count == 1
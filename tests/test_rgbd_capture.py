@@ -0,0 +1,75 @@
+from threading import Event
+import numpy as np
+import time
+from camera import Camera, Intrinsics
+from rgbd_capture import MultiRGBDCapture
+from rgbd_stream import RGBDFrame, RGBDStream
+
+
+class PooledStream(RGBDStream):
+    '''Produces frames whose pixels all hold the frame number, in a pool
+    of buffer sets reused round-robin like RGBDStream_iOS.'''
+
+    def __init__(self, frame_count, pool_size=3, shape=(8, 6)):
+        self.frame_count = frame_count
+        self.pool = [(np.empty(shape + (3,), np.uint8), np.empty(shape, np.float32), np.empty(shape, np.uint8))
+                     for _ in range(pool_size)]
+        self.index = 0
+        self.streaming = False
+        self.done = Event()
+
+    def start(self):
+        self.streaming = True
+
+    def is_running(self):
+        return self.streaming
+
+    def stop(self):
+        self.streaming = False
+
+    def wait_for_frames(self, timeout=None):
+        if self.index >= self.frame_count:
+            self.done.set()
+            time.sleep(timeout or 0.0)
+            return False
+        return True
+
+    def acquire_frame(self, buffers=None):
+        self.index += 1
+        shapes = [buffer.shape for buffer in self.pool[0]]
+        if buffers is None or [buffer.shape for buffer in buffers] != shapes:
+            buffers = self.pool[self.index % len(self.pool)]
+        rgb, depth, confidence = buffers
+        rgb[...] = self.index % 256
+        depth[...] = self.index
+        confidence[...] = self.index % 256
+        camera = Camera(Intrinsics(1.0, 1.0, 1.0, 1.0, 0.5, 0.5), np.zeros(3), np.eye(3))
+        return RGBDFrame(*buffers, camera)
+
+
+def test_slots_never_share_arrays():
+    history = 4
+    stream = PooledStream(frame_count=3 * (history + 2))
+    capture = MultiRGBDCapture([stream], history=history)
+    with capture:
+        assert stream.done.wait(5.0)
+
+    frames = [frame for frame, _, _ in capture._slots[0]]
+    assert all(frame is not None for frame in frames)
+    arrays = [array for frame in frames for array in (frame.rgb_u8, frame.depth, frame.confidence)]
+    for i, a in enumerate(arrays):
+        for b in arrays[i + 1:]:
+            assert not np.shares_memory(a, b)
+
+
+def test_held_frames_are_not_overwritten():
+    stream = PooledStream(frame_count=1000)
+    capture = MultiRGBDCapture([stream], history=4)
+    with capture:
+        while capture.get_frame_set() is None:
+            capture.wait_for_frames(timeout=1.0)
+        (frame,), (seq,), _ = capture.get_frame_set()
+        expected = frame.depth.copy()
+        assert stream.done.wait(5.0)
+    assert np.array_equal(frame.depth, expected)
+    assert np.all(frame.rgb_u8 == frame.depth[..., None] % 256)
@@ -0,0 +1,50 @@
+import numpy as np
+from camera import Camera, Intrinsics
+from rgbd_stream import RGBDFrame
+from voxel_map import VoxelMap
+
+
+class Scene:
+    '''A static background, plus a small patch of the image that sees
+    something new in every frame, as when objects move through the view.'''
+
+    def __init__(self, seed, shape=(96, 128), patch=32):
+        self.rng = np.random.default_rng(seed)
+        self.background = self.rng.uniform(1.0, 3.0, size=shape).astype(np.float32)
+        self.patch = patch
+        self.camera = Camera(Intrinsics(1.0, 1.0, 1.0, 1.0, 0.5, 0.5), np.zeros(3), np.eye(3))
+
+    def frame(self):
+        depth = self.background.copy()
+        depth[:self.patch, :self.patch] = self.rng.uniform(0.2, 0.95, size=(self.patch, self.patch))
+        rgb = np.zeros(depth.shape + (3,), dtype=np.uint8)
+        confidence = np.full(depth.shape, 2, dtype=np.uint8)
+        return RGBDFrame(rgb, depth, confidence, self.camera)
+
+
+def test_full_map_does_not_rebuild_every_frame():
+    scene = Scene(0)
+    voxel_map = VoxelMap(voxel_size=0.02, max_voxels=4000, stride=2)
+    full_frames = 0
+    for _ in range(100):
+        voxel_map.integrate(scene.frame())
+        assert len(voxel_map) <= voxel_map.max_voxels
+        full_frames += voxel_map.eviction_count > 0
+
+    assert voxel_map.eviction_count > 0
+    # Each eviction frees evict_fraction of the map, which takes several
+    # frames of new voxels to fill up again.
+    assert voxel_map.eviction_count < full_frames / 2
+
+
+def test_eviction_keeps_occupied_voxels():
+    scene = Scene(1)
+    voxel_map = VoxelMap(voxel_size=0.02, max_voxels=4000, stride=2)
+    for _ in range(5):
+        voxel_map.integrate(scene.frame())
+    occupied, _ = voxel_map.get_occupied_voxels(threshold=3.0)
+
+    for _ in range(50):
+        voxel_map.integrate(scene.frame())
+    assert voxel_map.eviction_count > 0
+    assert np.all(voxel_map.get_log_odds(occupied) >= 3.0)